@@ -0,0 +1,693 @@
+#!/usr/bin/env python
+##
+# @file benchmark.py
+#
+# Performance benchmarks for the cs164b parser and interpreter.
+#
+# Usage: python benchmark.py [benchmark ...]
+# With no arguments, every benchmark is run.
+#
+# Benchmarks that compare against an older version of the parser (memory)
+# look for a checkout of it in $BENCH_BASELINE, e.g.
+#   git worktree add /tmp/baseline <commit>
+#   BENCH_BASELINE=/tmp/baseline python benchmark.py memory
+import sys, os, time, re, subprocess, tempfile, shutil
+import parser_generator, grammar_parser
+
+GRAMMAR_FILE = './cs164b.grm'
+PROGRAM_FILES = ['./library.164', './object.164']
+
+##-----------------------------------------------------------------------------
+## Helpers
+##
+
+def makeParser (type='earley'):
+    return parser_generator.makeParser (open (GRAMMAR_FILE).read (), type)
+
+def timeIt (f, minTime=1.0):
+    '''Call F repeatedly for at least MINTIME seconds.  Returns
+    (seconds per call, result of the last call).'''
+    calls = 0
+    start = time.time ()
+    while True:
+        result = f ()
+        calls += 1
+        elapsed = time.time () - start
+        if elapsed >= minTime:
+            return elapsed / calls, result
+
+def syntheticProgram (lines):
+    '''Return a LINES-line program made of the library and object files.'''
+    source = []
+    for name in PROGRAM_FILES:
+        source.extend (open (name).read ().splitlines ())
+    return '\n'.join ([source[i % len (source)] for i in xrange (lines)])
+
+def expressionProgram (lines):
+    '''Return a LINES-line program of arithmetic-heavy statements.'''
+    source = []
+    for i in xrange (lines):
+        source.append ('def v%d = a%d * (b + %d) - f(x, y[%d]) / 4 == c && d || e.g + %d'
+                       % (i, i % 7, i, i % 3, i))
+    return '\n'.join (source)
+
+def statements (text):
+    '''Split TEXT into lines the way repl.loadProgram does.'''
+    return re.findall ('[^\r\n;]+', re.sub ("#.*\r?\n", "", text))
+
+def parseProgram (parser, text, onStatement=None, onDemand=False):
+    '''Parse TEXT statement by statement, as repl.loadProgram does, and
+    call ONSTATEMENT(parser) after each one.  Returns (asts, tokens).
+    With ONDEMAND, the parser is sent the text of each line to lex as it
+    goes, rather than its tokens; TOKENS is then 0.'''
+    newline = parser.tokenize ('\n')
+    asts = []
+    count = 0
+    coroutine = None
+    for line in statements (text):
+        if onDemand:
+            tokens = line.strip () and line
+        else:
+            tokens = parser.tokenize (line)
+        if not tokens:
+            continue
+        if coroutine is None:
+            coroutine = parser.parse ()
+            coroutine.next ()
+        else:
+            tokens = (onDemand and '\n' or newline) + tokens
+        count += len (tokens) * (not onDemand)
+        ast = coroutine.send (tokens)
+        if type (ast) == tuple:
+            asts.append (ast)
+            if onStatement:
+                onStatement (parser)
+            coroutine = None
+    return asts, count
+
+def statementTokens (parser, text):
+    '''Return the tokens of each statement of TEXT, as parseProgram
+    sends them, put together.'''
+    newline = parser.tokenize ('\n')
+    result = []
+    tokens = []
+    coroutine = None
+    for line in statements (text):
+        line = parser.tokenize (line)
+        if not line:
+            continue
+        if coroutine is None:
+            coroutine = parser.parse ()
+            coroutine.next ()
+        else:
+            line = newline + line
+        tokens += line
+        if type (coroutine.send (line)) == tuple:
+            result.append (tokens)
+            tokens = []
+            coroutine = None
+    return result
+
+def parseInputs ():
+    '''The programs the parser benchmarks run on.'''
+    inputs = [(name, open (name).read ()) for name in PROGRAM_FILES]
+    inputs.append (('expressions (200 lines)', expressionProgram (200)))
+    return inputs
+
+def report (name, rows):
+    '''Print a table of ROWS, a list of (label, value, unit).'''
+    print name
+    for label, value, unit in rows:
+        print '    %-56s %12.1f %s'% (label, value, unit)
+
+##-----------------------------------------------------------------------------
+## Lexer
+##
+
+def naiveTokenize (terminals, inp):
+    '''The original tokenizer: try every terminal at every position.'''
+    tokens = []
+    pos = 0
+
+    while True:
+        matchLHS = 0
+        matchText = None
+        matchEnd = -1
+
+        for regex, lhs in terminals:
+            match = regex.match (inp, pos)
+            if match and match.end () > matchEnd:
+                matchLHS = lhs
+                matchText = match.group ()
+                matchEnd = match.end ()
+
+        if pos == len (inp):
+            if matchLHS:  tokens.append ((matchLHS, matchText))
+            break
+        elif pos == matchEnd:
+            raise NameError, pos
+        elif matchLHS is None:
+            pass
+        elif matchLHS:
+            tokens.append ((matchLHS, matchText))
+        else:
+            raise NameError, str(pos)
+
+        pos = matchEnd
+
+    return tokens
+
+def benchLexer ():
+    '''Tokens/sec of the combined lexer against the per-terminal loop.'''
+    parser = makeParser ()
+    inputs = [(name, open (name).read ()) for name in PROGRAM_FILES]
+    inputs.append (('synthetic (100k lines)', syntheticProgram (100000)))
+
+    rows = []
+    for name, text in inputs:
+        naive, tokens = timeIt (lambda: naiveTokenize (parser.terminals, text))
+        combined, check = timeIt (lambda: parser.tokenize (text))
+        assert tokens == check
+        rows.append (('%s, per-terminal loop'% (name), len (tokens) / naive, 'tokens/s'))
+        rows.append (('%s, combined lexer'% (name), len (tokens) / combined, 'tokens/s'))
+    report ('lexer', rows)
+
+def benchOnDemand ():
+    '''Parse speed with the batch tokenizer against lexing on demand,
+    a token at a time as the parser gets to it.'''
+    parser = makeParser ()
+    rows = []
+    for name, text in parseInputs ():
+        asts, tokens = parseProgram (parser, text)
+        for label, onDemand in (('batch tokenizer', False), ('on demand', True)):
+            seconds, (check, _) = timeIt (lambda: parseProgram (parser, text, onDemand=onDemand))
+            assert check == asts
+            rows.append (('%s, %s'% (name, label), tokens / seconds, 'tokens/s'))
+    report ('ondemand', rows)
+
+##-----------------------------------------------------------------------------
+## Earley prediction
+##
+
+def benchPredict ():
+    '''Edges per token without the prediction tables, with them, and with
+    them filtered by the next token.'''
+    parser = makeParser ()
+    parser.engine = 'fixpoint'
+    rows = []
+    for name, text in parseInputs ():
+        for label, tables, lookahead in (('no tables', False, False),
+                                         ('tables', True, False),
+                                         ('tables + lookahead', True, True)):
+            parser.predictionTables = tables
+            parser.lookahead = lookahead
+            counts = [0, 0, 0, 0]
+            def count (parser):
+                counts[0] += parser.edgesTried
+                counts[1] += parser.edgesAdded
+                counts[2] += parser.passes
+                counts[3] += parser.predictionsAvoided
+            asts, tokens = parseProgram (parser, text, count)
+            seconds, result = timeIt (lambda: parseProgram (parser, text))
+            label = '%s, %s'% (name, label)
+            rows.append ((label + ': edges tried', counts[0] / float (tokens), 'per token'))
+            rows.append ((label + ': edges added', counts[1] / float (tokens), 'per token'))
+            if lookahead:
+                rows.append ((label + ': predictions avoided', counts[3] / float (tokens), 'per token'))
+            rows.append ((label + ': passes', counts[2] / float (tokens), 'per token'))
+            rows.append ((label + ': parse', tokens / seconds, 'tokens/s'))
+    report ('predict', rows)
+
+##-----------------------------------------------------------------------------
+## Earley engines
+##
+
+def benchEngine ():
+    '''Parse speed of the worklist engine against the fixpoint loop.'''
+    parser = makeParser ()
+    rows = []
+    for name, text in parseInputs ():
+        results = {}
+        for engine in ('fixpoint', 'worklist'):
+            parser.engine = engine
+            seconds, (asts, tokens) = timeIt (lambda: parseProgram (parser, text))
+            results[engine] = asts
+            rows.append (('%s, %s'% (name, engine), tokens / seconds, 'tokens/s'))
+        assert results['fixpoint'] == results['worklist']
+    report ('engine', rows)
+
+def benchLALR ():
+    '''Parse speed of the Earley, LALR(1) and hybrid parsers.  The hybrid
+    parser must produce exactly the Earley parser's ASTs.'''
+    rows = []
+    for name, text in parseInputs ():
+        results = {}
+        for type in ('earley', 'lalr', 'hybrid'):
+            parser = makeParser (type)
+            results[type], tokens = parseProgram (parser, text)
+            label = '%s, %s'% (name, type)
+            if type == 'hybrid':
+                label += ' (%d/%d to Earley)'% (parser.fallbacks, parser.statements)
+            seconds, _ = timeIt (lambda: parseProgram (parser, text))
+            rows.append ((label, tokens / seconds, 'tokens/s'))
+        assert results['hybrid'] == results['earley']
+    report ('lalr', rows)
+
+def benchReduce ():
+    '''Parse speed and chart edges with and without EarleyParser.reduce,
+    which must not change the ASTs.'''
+    text = open (GRAMMAR_FILE).read ()
+    rows = []
+    parsers = {}
+    for reduce in (False, True):
+        compiled = parser_generator.EarleyParser.compile (grammar_parser.parse (text), reduce)
+        earley = parser_generator.EarleyParser (None, compiled)
+        parsers[reduce] = (earley, parser_generator.LALRParser (earley, fallback=True))
+    for change in parsers[True][0].reductions:
+        print '   ', change
+    for name, text in parseInputs ():
+        results = {}
+        for reduce in (False, True):
+            earley, hybrid = parsers[reduce]
+            label = '%s, %s'% (name, reduce and 'reduced' or 'as written')
+            edges = [0]
+            def count (parser):
+                edges[0] += parser.edgesAdded
+            results[reduce], tokens = parseProgram (earley, text, count)
+            rows.append ((label + ', edges', edges[0], ''))
+            seconds, _ = timeIt (lambda: parseProgram (earley, text))
+            rows.append ((label + ', earley', tokens / seconds, 'tokens/s'))
+            seconds, _ = timeIt (lambda: parseProgram (hybrid, text))
+            rows.append ((label + ', hybrid', tokens / seconds, 'tokens/s'))
+        assert results[False] == results[True]
+    report ('reduce', rows)
+
+def benchStats ():
+    '''Parse speed with and without statistics, and where the time goes.'''
+    parser = makeParser ()
+    rows = []
+    for name, text in parseInputs ():
+        totals = {}
+        def collect (parser):
+            stats = parser.stats
+            for phase, seconds in stats.time.iteritems ():
+                totals[phase] = totals.get (phase, 0.0) + seconds
+            totals['total'] = totals.get ('total', 0.0) + stats.wallTime
+        for collectStats in (False, True):
+            parser.collectStats = collectStats
+            seconds, (asts, tokens) = timeIt (lambda: parseProgram (parser, text))
+            rows.append (('%s, stats %s'% (name, collectStats and 'on' or 'off'),
+                          tokens / seconds, 'tokens/s'))
+        parseProgram (parser, text, collect)
+        for phase in ('scan', 'predict', 'complete', 'sdt'):
+            rows.append (('%s, %s'% (name, phase), 100 * totals[phase] / totals['total'], '%'))
+    parser.collectStats = False
+    report ('stats', rows)
+
+def benchRecognize ():
+    '''Speed of recognizing statements against parsing them, and a check
+    that the recognizer tells complete, incomplete and bad input apart.'''
+    parser = makeParser ()
+    rows = []
+    for name, text in parseInputs ():
+        stmts = statementTokens (parser, text)
+        tokens = sum ([len (stmt) for stmt in stmts])
+        def parse ():
+            for stmt in stmts:
+                coroutine = parser.parse ()
+                coroutine.next ()
+                coroutine.send (stmt)
+        def recognize ():
+            return [parser.recognize (stmt) for stmt in stmts]
+        seconds, _ = timeIt (parse)
+        rows.append (('%s, parse'% (name), tokens / seconds, 'tokens/s'))
+        seconds, results = timeIt (recognize)
+        rows.append (('%s, recognize'% (name), tokens / seconds, 'tokens/s'))
+        assert results == [True] * len (stmts)
+        unclosed = [stmt[:-1] for stmt in stmts if stmt[-1][1] == '}']
+        assert [parser.recognize (stmt) for stmt in unclosed] == [None] * len (unclosed)
+        assert parser.recognize (stmts[0] + stmts[0][:1] * 2) is False
+    report ('recognize', rows)
+
+def benchLoader ():
+    '''Speed of loading a big program with repl.parseProgram on pools of
+    1, 2, 4 and 8 processes, which must all give the ASTs of parsing it
+    line by line.'''
+    import repl
+    parser = makeParser ('hybrid')
+    lines = statements (syntheticProgram (20000))
+    expected, _ = parseProgram (parser, '\n'.join (lines))
+    rows = []
+    for processes in (1, 2, 4, 8):
+        seconds, (asts, error) = timeIt (lambda: repl.parseProgram (parser, lines, processes))
+        assert error is None and asts == expected
+        rows.append (('%d lines, %d processes'% (len (lines), processes), seconds * 1000, 'ms'))
+    report ('loader (%d CPUs)'% (repl.multiprocessing.cpu_count ()), rows)
+
+##-----------------------------------------------------------------------------
+## Disambiguation
+##
+
+def operatorChain (operands):
+    '''Return one statement whose expression chains OPERANDS operands with
+    mixed binary operators, so that almost every completion is ambiguous.'''
+    ops = ['+', '*', '-', '/', '==', '&&']
+    return 'def x = ' + ' '.join (['a%d %s'% (i, ops[i % len (ops)])
+                                   for i in xrange (operands - 1)]) + ' z'
+
+def benchAmbiguity ():
+    '''Parse speed of single, highly ambiguous expressions.'''
+    parser = makeParser ()
+    rows = []
+    for operands in (25, 50, 100):
+        tokens = parser.tokenize (operatorChain (operands))
+        def parse ():
+            coroutine = parser.parse ()
+            coroutine.next ()
+            return coroutine.send (tokens)
+        seconds, ast = timeIt (parse)
+        rows.append (('chain of %d operands'% (operands), len (tokens) / seconds, 'tokens/s'))
+        rows.append (('chain of %d operands: edges added'% (operands),
+                      parser.edgesAdded / float (len (tokens)), 'per token'))
+    report ('ambiguity', rows)
+
+##-----------------------------------------------------------------------------
+## Deep nesting
+##
+
+def nestedExpression (depth):
+    '''Return a statement whose expression nests DEPTH additions.'''
+    return 'def x = ' + '(1 + ' * depth + '1' + ')' * depth
+
+def benchNesting ():
+    '''Parse speed of a 10,000-deep nested expression (tests.py checks
+    its AST).'''
+    parser = makeParser ()
+    depth = 10000
+    tokens = parser.tokenize (nestedExpression (depth))
+    start = time.time ()
+    coroutine = parser.parse ()
+    coroutine.next ()
+    coroutine.send (tokens)
+    seconds = time.time () - start
+    report ('nesting', [('%d-deep expression'% (depth), len (tokens) / seconds, 'tokens/s')])
+
+##-----------------------------------------------------------------------------
+## Parser memory
+##
+
+def bigDefBody (lines):
+    '''Return the tokens of one def whose body is LINES lines long, as the
+    REPL would hand them to the parser.'''
+    source = ['def big(a, b) {']
+    for i in xrange (lines):
+        source.append ('    def v%d = a * (b + %d) - f(v%d, x.y[%d])'% (i, i, i, i))
+    source.extend (['    a', '}'])
+    return source
+
+# Run in a fresh interpreter, so that each measurement has a peak RSS of
+# its own.  Prints the token count and the peak RSS (in kB) before and after
+# the parse.  On Linux, ru_maxrss survives exec, so that the child would
+# report the benchmark process's own peak; VmHWM does not.
+MEMORY_CHILD = '''
+import sys, os, resource
+def peak ():
+    try:
+        for line in open ('/proc/self/status'):
+            if line.startswith ('VmHWM:'):
+                return int (line.split ()[1])
+    except IOError:
+        pass
+    return resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+sys.setrecursionlimit (100000)
+os.chdir (%(root)r)
+sys.path.insert (0, %(root)r)
+import parser_generator, grammar_parser
+parser = parser_generator.makeParser (grammar_parser.parse (open (%(grammar)r).read ()))
+parser.pruneEvery = %(pruneEvery)r
+lines = []
+for line in %(source)r:
+    lines.append ((lines and parser.tokenize ('\\n') or []) + parser.tokenize (line))
+before = peak ()
+coroutine = parser.parse ()
+coroutine.next ()
+for line in lines:
+    ast = coroutine.send (line)
+assert type (ast) == tuple
+print sum (map (len, lines)), before, peak ()
+'''
+
+def peakMemory (root, source, pruneEvery=100000):
+    '''Parse SOURCE, a line at a time, with the parser in ROOT in a child
+    process.  Returns (tokens, peak RSS in kB before the parse, peak RSS
+    after).'''
+    code = MEMORY_CHILD % {'root': os.path.abspath (root), 'grammar': GRAMMAR_FILE,
+                           'source': source, 'pruneEvery': pruneEvery}
+    output = subprocess.Popen ([sys.executable, '-'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE).communicate (code)[0]
+    return [int (field) for field in output.split ()]
+
+def benchMemory ():
+    '''Peak RSS of parsing one large multi-line def, with the chart
+    pruned as the parse goes and kept whole.'''
+    trees = [('current', '.', 100000), ('current, no pruning', '.', None)]
+    if os.environ.get ('BENCH_BASELINE'):
+        trees.insert (0, ('baseline', os.environ['BENCH_BASELINE'], None))
+    rows = []
+    for lines in (250, 1000, 5000):
+        source = bigDefBody (lines)
+        for name, root, pruneEvery in trees:
+            tokens, before, after = peakMemory (root, source, pruneEvery)
+            label = 'def with a %d-line body (%d tokens), %s'% (lines, tokens, name)
+            rows.append ((label + ': peak RSS', after / 1024.0, 'MB'))
+            rows.append ((label + ': growth', (after - before) / 1024.0, 'MB'))
+    report ('memory', rows)
+
+##-----------------------------------------------------------------------------
+## Grammar loading
+##
+
+def bigGrammar (rules):
+    '''Return the cs164b grammar with RULES more rules, of three
+    productions each, as a generated DSL variant would add.'''
+    spec = [open (GRAMMAR_FILE).read ()]
+    for i in xrange (rules):
+        spec.append ('''
+K%(i)d    ->  'kw%(i)d' E                         %%{ return ('kw%(i)d', n2.val) %%}
+        |   K%(i)d ',' /x%(i)d[0-9]*/ E %%dprec 1  %%{ return n1.val + (n3.val, n4.val) %%}
+        |   %%{ n1.val = %(i)d %%} id '(' V ')'       // a call
+        ;
+''' % {'i': i})
+    return ''.join (spec)
+
+def benchGrammar ():
+    '''Speed of grammar_parser on the cs164b grammar and on generated
+    grammars with thousands of productions.'''
+    rows = []
+    for rules in (0, 1000, 5000):
+        spec = bigGrammar (rules)
+        seconds, g = timeIt (lambda: grammar_parser.parse (spec))
+        productions = sum ([len (rule.productions) for rule in g.rules])
+        rows.append (('%d productions'% (productions), seconds * 1000, 'ms'))
+    report ('grammar', rows)
+
+##-----------------------------------------------------------------------------
+## Startup
+##
+
+# Run in a fresh interpreter; prints the seconds from start-up until the
+# parser is ready, with the grammar cache in CACHE.
+STARTUP_CHILD = '''
+import time
+start = time.time ()
+import parser_generator
+parser_generator.GRAMMAR_CACHE = %(cache)r
+parser = parser_generator.makeParser (open (%(grammar)r).read ())
+print time.time () - start
+'''
+
+def startupTime (cache, runs=11):
+    '''Median seconds to start a parser with the grammar cache in CACHE.
+    With CACHE 'cold', every run starts from an empty cache.'''
+    times = []
+    for i in xrange (runs):
+        directory = tempfile.mkdtemp () if cache == 'cold' else cache
+        code = STARTUP_CHILD % {'cache': directory, 'grammar': GRAMMAR_FILE}
+        output = subprocess.Popen ([sys.executable, '-c', code],
+                                   stdout=subprocess.PIPE).communicate ()[0]
+        times.append (float (output))
+        if cache == 'cold':
+            shutil.rmtree (directory)
+    return sorted (times)[runs / 2]
+
+def benchStartup ():
+    '''Parser start-up time without the grammar cache, with an empty
+    cache, and with a cache that already holds the grammar.'''
+    warm = tempfile.mkdtemp ()
+    try:
+        startupTime (warm, 1)
+        rows = [('no cache', startupTime (None) * 1000, 'ms'),
+                ('cold cache', startupTime ('cold') * 1000, 'ms'),
+                ('warm cache', startupTime (warm) * 1000, 'ms')]
+    finally:
+        shutil.rmtree (warm)
+    report ('startup', rows)
+
+##-----------------------------------------------------------------------------
+## Interpreter
+##
+
+class BenchRepl:
+    '''Stands in for the REPL the interpreter prints and reports errors to.'''
+    def __init__ (self):
+        self.output = []
+        self.exec_fail = False
+
+    def printLine (self, s, code=0, attr=0):
+        self.output.append (s)
+
+    def softError (self, s):
+        self.output.append ('Error: ' + s)
+        self.exec_fail = True
+
+    def gracefulExit (self, msg=None, ret=0):
+        raise SystemExit (msg)
+
+# (name, definitions, expression to time, its value)
+INTERPRETER_PROGRAMS = [
+    ('fib(18)',
+     'def fib(n) { if (n < 2) { n } else { fib(n - 1) + fib(n - 2) } }',
+     'fib(18)', 2584),
+    ('while loop, 5000 iterations',
+     'def loop(n) { def i = 0; def s = 0; while (i < n) { s = s + i; i = i + 1 }; s }',
+     'loop(5000)', 12497500),
+    ('closures, 5000 calls',
+     'def counter() { def k = 0; lambda() { k = k + 1; k } }\n'
+     'def count(n) { def c = counter(); def i = 0; while (i < n) { c(); i = i + 1 }; c() }',
+     'count(5000)', 5001),
+]
+
+def runProgram (parser, repl, text):
+    '''Parse TEXT and run it in the global environment.'''
+    import interpreter
+    for ast in parseProgram (parser, text)[0]:
+        interpreter.ExecGlobalStmt (ast, repl)
+
+def benchInterpreter ():
+    '''Run time of small cs164b programs.'''
+    parser = makeParser ('hybrid')
+    rows = []
+    for name, definitions, expression, value in INTERPRETER_PROGRAMS:
+        repl = BenchRepl ()
+        runProgram (parser, repl, definitions)
+        seconds, _ = timeIt (lambda: runProgram (parser, repl, 'print ' + expression))
+        assert repl.output[-1] == str (value), repl.output[-1]
+        rows.append ((name, seconds * 1000, 'ms'))
+    report ('interpreter', rows)
+
+class CountedCode (list):
+    '''Code that counts the instructions Resume fetches from it.'''
+    fetched = 0
+    def __getitem__ (self, i):
+        CountedCode.fetched += 1
+        return list.__getitem__ (self, i)
+
+def instructionCount (parser, definitions, expression):
+    '''The number of instructions the interpreter runs to print
+    EXPRESSION after DEFINITIONS, compiling both into CountedCode.'''
+    import interpreter
+    resolve = interpreter.resolve
+    interpreter.resolve = lambda *args: CountedCode (resolve (*args))
+    try:
+        repl = BenchRepl ()
+        runProgram (parser, repl, definitions)
+        CountedCode.fetched = 0
+        runProgram (parser, repl, 'print ' + expression)
+        return CountedCode.fetched
+    finally:
+        interpreter.resolve = resolve
+
+def benchDispatch ():
+    '''Instructions per second of the interpreter on fib and a while loop.'''
+    parser = makeParser ('hybrid')
+    rows = []
+    for name, definitions, expression, value in INTERPRETER_PROGRAMS[:2]:
+        count = instructionCount (parser, definitions, expression)
+        repl = BenchRepl ()
+        runProgram (parser, repl, definitions)
+        seconds, _ = timeIt (lambda: runProgram (parser, repl, 'print ' + expression))
+        assert repl.output[-1] == str (value), repl.output[-1]
+        rows.append ((name + ', instructions', count, ''))
+        rows.append ((name + ', instructions/s', count / seconds / 1e6, 'M'))
+    report ('dispatch', rows)
+
+def benchTailCalls (calls=10000000):
+    '''Time and memory of recursing CALLS times in tail position.'''
+    import resource
+    parser = makeParser ('hybrid')
+    repl = BenchRepl ()
+    runProgram (parser, repl, 'def down(n) { if (n == 0) { "bottom" } else { down(n - 1) } }')
+    runProgram (parser, repl, 'print down(1000)')
+    before = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    start = time.time ()
+    runProgram (parser, repl, 'print down(%d)' % calls)
+    seconds = time.time () - start
+    after = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    assert repl.output[-1] == 'bottom', repl.output[-1]
+    report ('tailcall', [('down(%d)' % calls, seconds, 's'),
+                         ('peak RSS growth', after - before, 'kB')])
+
+def benchRegisters (loads=1000):
+    '''Memory of loading library.164 LOADS times into one global
+    environment (tests.py checks that no temps pile up in it).'''
+    import interpreter, resource
+    parser = makeParser ('hybrid')
+    asts = parseProgram (parser, open ('library.164').read ())[0]
+    repl = BenchRepl ()
+    rows = []
+    before = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    start = time.time ()
+    for i in range (loads):
+        for ast in asts:
+            interpreter.ExecGlobalStmt (ast, repl)
+        if i == 0:
+            rows.append (('globals after 1 load', len (interpreter.globEnv), ''))
+    seconds = time.time () - start
+    after = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    rows.append (('globals after %d loads' % loads, len (interpreter.globEnv), ''))
+    rows.append (('peak RSS growth', after - before, 'kB'))
+    if loads:
+        rows.append (('time per load', seconds * 1000 / loads, 'ms'))
+    report ('registers', rows)
+
+##-----------------------------------------------------------------------------
+
+BENCHMARKS = [
+    ('lexer', benchLexer),
+    ('ondemand', benchOnDemand),
+    ('predict', benchPredict),
+    ('engine', benchEngine),
+    ('lalr', benchLALR),
+    ('reduce', benchReduce),
+    ('stats', benchStats),
+    ('recognize', benchRecognize),
+    ('loader', benchLoader),
+    ('ambiguity', benchAmbiguity),
+    ('nesting', benchNesting),
+    ('memory', benchMemory),
+    ('grammar', benchGrammar),
+    ('startup', benchStartup),
+    ('interpreter', benchInterpreter),
+    ('dispatch', benchDispatch),
+    ('registers', benchRegisters),
+    ('tailcall', benchTailCalls),
+]
+
+def main (argv):
+    names = argv[1:] or [name for name, f in BENCHMARKS]
+    for name, f in BENCHMARKS:
+        if name in names:
+            f ()
+
+if __name__ == '__main__':
+    main (sys.argv)
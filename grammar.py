@@ -32,6 +32,10 @@ class Production:
 
     opPrec:
     opAssoc:
+
+    OPERATORS, on a production X -> @X.operators made by
+    EarleyParser.operatorRules, is the list of binary operator
+    productions whose chains it builds into trees.
     '''
     def __init__ (self, lhs, rhs, actions, prec, assoc, subsym):
         '''Create a new production'''
@@ -45,6 +49,7 @@ class Production:
         self.opPrec = None
         self.opAssoc = None
         self.info = None
+        self.operators = None
 
 
     def toString (self,invRenamedTerminals):
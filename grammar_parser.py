@@ -10,13 +10,17 @@ import grammar, re, sys, types
 class Tokenizer:
     '''A very simple stream tokenizer.'''
 
+    patterns = {}   # compiled regexes, by source, shared by all Tokenizers
+
     def __init__ (self, input, whitespace='[ ]', comments='#'):
         '''Create a new Tokenizer on INPUT.  Optionally accepts regexes
         for WHITESPACE and COMMENTS to be ignored.'''
         self.input = input
         self.__pos = 0
+        self.__skipped = (None, None)   # (from, to) of the last skip
         self.whitespace = re.compile (whitespace, re.VERBOSE)
         self.comments = re.compile (comments, re.VERBOSE)
+        self.ignored = re.compile ('(?: %s | %s )*'% (whitespace, comments), re.VERBOSE)
 
 
     def checkpoint (self):
@@ -39,17 +43,32 @@ class Tokenizer:
 
         If there is a match, updates the current position within
         the input string.
+
+        String regexes are compiled once, not on every call; re's own
+        cache is flushed whenever it fills, which a big grammar does.
         '''
-        # Skip whitespace and comments
-        while (self.__matchToken (self.whitespace)
-               or self.__matchToken (self.comments)):
-            pass
+        self.skip ()
 
         # Return the match of REGEX
         if isinstance (regex, types.StringType):
-            return self.__matchToken (re.compile (regex, re.VERBOSE))
-        else:
-            return self.__matchToken (regex)
+            pattern = Tokenizer.patterns.get (regex)
+            if pattern is None:
+                pattern = Tokenizer.patterns[regex] = re.compile (regex, re.VERBOSE)
+            regex = pattern
+        return self.__matchToken (regex)
+
+
+    def skip (self):
+        '''Skip whitespace and comments at the current position.  Only
+        the first skip from a position does any matching; backtracking
+        to it again reuses where that one ended.'''
+        skipFrom, skipTo = self.__skipped
+        if self.__pos == skipFrom or self.__pos == skipTo:
+            self.__pos = skipTo
+            return
+        skipFrom = self.__pos
+        self.__matchToken (self.ignored)
+        self.__skipped = (skipFrom, self.__pos)
 
 
     def __matchToken (self, regex):
@@ -94,9 +113,32 @@ def parse (spec, filename='stdin'):
         stack.__setslice__(0, len (stack), stack[0:checkpoint[1]])
         return True
 
+    def packrat (rule):
+        '''Memoize RULE, which must do nothing but push onto the semantic
+        stack, on the position it starts at: backtracking to a position
+        then replays the result, end position and values pushed, rather
+        than parsing the input again.  The position is taken past any
+        whitespace, which the first token of RULE would skip anyway.'''
+        def memoized ():
+            lexer.skip ()
+            key = (rule, lexer.checkpoint ())
+            if key not in memo:
+                depth = len (stack)
+                result = rule ()
+                memo[key] = (result, lexer.checkpoint (), stack[depth:])
+                return result
+            result, end, values = memo[key]
+            lexer.restore (end)
+            stack.extend (values)
+            return result
+        return memoized
+
 
     lexer = Tokenizer (spec, r'[ \n\r\t\v\f]+', r'//[^\n\r]*?(?:[\n\r]|$)')
     stack = []                          # semantic stack
+    terminals = {}                      # compiled terminals, by regex
+    memo = {}                           # (rule, position) -> (result, end, values pushed),
+                                        # for the rule being parsed
     g = grammar.Grammar ()              # the grammar to build
 
     def G ():
@@ -193,6 +235,7 @@ def parse (spec, filename='stdin'):
         if not lexer.token (';'):
             error ('(%s) rules must be ended by ";"'% (rule.lhs))
 
+        memo.clear ()                   # no backtracking past a whole rule
         stack.append (rule)
         return True
 
@@ -288,7 +331,7 @@ def parse (spec, filename='stdin'):
         match = lexer.token (r'\'.*?\'')
         if not match:
             return False
-        stack.append (re.compile (re.escape (match[1:-1])))
+        stack.append (terminal (re.escape (match[1:-1])))
         return True
 
     def Regex ():
@@ -296,11 +339,16 @@ def parse (spec, filename='stdin'):
         if not match:
             return False
         try:
-            stack.append (re.compile (match[1:-1]))
+            stack.append (terminal (match[1:-1]))
         except:
             error ('invalid regular expression')
         return True
 
+    def terminal (regex):
+        if regex not in terminals:
+            terminals[regex] = re.compile (regex)
+        return terminals[regex]
+
     def Epsilon ():
         if not lexer.token ('_'):
             return False
@@ -315,6 +363,7 @@ def parse (spec, filename='stdin'):
         stack.append (match)
         return True
 
+    @packrat
     def Action ():
         match = lexer.token (r'%\{ (?: . | [\n\r])*? %\}')
         if not match:
@@ -20,9 +20,11 @@ def ExecGlobalStmt(ast,repl=None):
 # ('=', lhs, rhs)                 --  lhs = rhs
 # ('ite', cond, then, else)       --  ite(cond, then, else)
 # ('def', var, val)               --  def var = val
+# ('int', var, 5)                 --  def var = 5
 # (op, lhs, val1, val2)           --  lhs = val1 op val2  where op = {'+', '==', etc.}
 # ('lambda', lhs, params, body)   --  lhs = lambda (params) {body}
 # ('call', lhs, fun, args)        --  lhs = fun(args)
+# ('tail-call', lhs, fun, args)   --  return fun(args)
 # ('coroutine', lhs, fun)         --  lhs = coroutine(fun)
 # ('resume', lhs, co, arg)        --  lhs = resume(co, arg)
 # ('yield', lhs,  arg)            --  lhs = yield(arg)
@@ -30,8 +32,14 @@ def ExecGlobalStmt(ast,repl=None):
 # ('string-lit', reg, "foo")      --  "foo"
 # ('null', reg)                   --  null
 # ('return', reg)                 --  ?
+# ('jump', n)                     --  skip the next n instructions (back if n < 0)
+# ('jump-if', var, n)             --  ... if var is true
+# ('jump-unless', var, n)         --  ... if var is false
 # The bytecode array stores instructions of the main scope; bytecode arrays
 # for lambda bodies are nested bytecode arrays, stored in the call instruction
+#
+# Variables are resolved before the code runs (see resolve), so the
+# variables above end up as addresses in the frames of the interpreter.
 
 cnt = 0
 def bytecode(e):
@@ -39,19 +47,20 @@ def bytecode(e):
         global cnt
         cnt = cnt + 1
         return '$'+str(cnt)
+    def block(e,t):     # a list of statements, leaving the value of the last in t
+        codeList = reduce(lambda code,s: code+bc(s,t), e, [])
+        if len(codeList) == 0:
+            codeList = [('null', t)]
+        return codeList
     def bc(e,t):
         t1, t2, t3 = newTemp(), newTemp(), newTemp()
         if type(e) == type([]): # is a list of statements (body of function or outer level code)
-            codeList = reduce(lambda code,s: code+bc(s,t), e, [])
-            if len(codeList) == 0:
-                codeList = [('null', t)]
-            codeList.append(('return', t))
-            return codeList
+            return tailCalls(block(e,t) + [('return', t)])
 
         if type(e) == type(()): # e is an expression or a statement
             # expressions
-            if e[0] == 'int-lit'     or \
-               e[0] == 'var':        return [('def', t, e[1])]
+            if e[0] == 'int-lit':    return [('int', t, e[1])]
+            if e[0] == 'var':        return [('def', t, e[1])]
             if e[0] == 'dict-lit':   return [('dict', t)]
             if e[0] == 'string-lit': return [('string', t, e[1])]
             if e[0] == 'null':       return [('null', t)]
@@ -66,6 +75,14 @@ def bytecode(e):
                e[0] == '<' or \
                e[0] == '>':         return bc(e[1],t1) + bc(e[2],t2) + [(e[0], t, t1, t2)]
             if e[0] == 'ite':       return bc(e[1],t1) + bc(e[2],t2) + bc(e[3],t3) + [(e[0], t, t1, t2, t3)]
+            if e[0] == '&&':
+                first, second = bc(e[1],t1), bc(e[2],t2)
+                return first + [('jump-unless', t1, len(second) + 3)] + second + \
+                       [('jump-unless', t2, 2), ('int', t, 1), ('jump', 1), ('int', t, 0)]
+            if e[0] == '||':
+                first, second = bc(e[1],t1), bc(e[2],t2)
+                return first + [('jump-if', t1, len(second) + 3)] + second + \
+                       [('jump-if', t2, 2), ('int', t, 0), ('jump', 1), ('int', t, 1)]
             if e[0] == 'coroutine': return bc(e[1],t1) + [('coroutine', t, t1)]
             if e[0] == 'yield':     return bc(e[1],t1) + [('yield', t, t1)]
             if e[0] == 'resume':    return bc(e[1],t1) + bc(e[2],t2) + [('resume', t, t1, t2)]
@@ -108,23 +125,218 @@ def bytecode(e):
             if e[0] == 'def':       return bc(e[2],t) + [('def',e[1],t)]
             if e[0] == 'print':     return bc(e[1],t) + [('print', t)]
             if e[0] == 'error':     return bc(e[1],t) + [('error', t)]
+            if e[0] == 'if':        # the value of the branch taken, null for a missing else
+                cond, then, other = bc(e[1],t1), block(e[2],t), block(e[3] or [],t)
+                return cond + [('jump-unless', t1, len(then) + 1)] + then + [('jump', len(other))] + other
+            if e[0] == 'while':     # always null
+                loop = bc(e[1],t1)
+                body = block(e[2],t2)
+                loop = loop + [('jump-unless', t1, len(body) + 1)] + body
+                return loop + [('jump', -len(loop) - 1), ('null', t)]
         raise SyntaxError("Illegal AST node %s " % str(e))
     t = newTemp()
-    return t,bc(e,t)
+    code = bc(e,t)
+    return t,resolve(code,[],registers(code,0)[0])
+
+# mark the calls of CODE whose value it returns right away, maybe after
+# some jumps, as tail calls: their callee returns straight to our caller
+def tailCalls(code):
+    result = list(code)
+    for i, inst in enumerate(code):
+        if inst[0] == 'call':
+            j = i + 1
+            while code[j][0] == 'jump':
+                j = j + 1 + code[j][1]
+            if code[j] == ('return', inst[1]):
+                result[i] = ('tail-call',) + inst[1:]
+    return result
+
+# Scope analysis.  The body of a lambda runs in a frame of its own, a list
+#   [parent env, Fun, slot 2, slot 3, ...]
+# holding its parameters, then every variable its code defines, and then
+# the registers holding its temps (see Fun).  Top-level code runs in a dict,
+# globEnv, which the REPL adds to statement by statement, so globals stay
+# looked up by name; its temps go in a register list of their own, and
+# never into globEnv.  resolve turns each variable of the code into an
+# address:
+#   slot            --  that slot (or register) of the current frame
+#   name            --  a global, looked up by name from the current env (a dict)
+#   (depth, slot)   --  that slot of the frame depth levels up
+#   (depth, name)   --  a global, looked up by name from the env depth levels up
+# A frame's slots start out UNSET.  A variable read or assigned before its
+# frame defines it is looked up by name from the frame above, just as when
+# frames were dicts (see Resume).
+
+# what each operand of an instruction is: 'w' a variable it defines in the
+# current frame, 'r' one it reads, 'u' one it assigns to, 'a' a list of
+# variables it reads, and '-' anything else
+OPERANDS = {'=': 'ur', 'dict': 'w', 'string': 'w-', 'def': 'wr', 'int': 'w-', 'null': 'w',
+            'print': 'r', 'error': 'r', 'ite': 'wrrr', 'lambda': 'w--',
+            'len': 'wr', 'type': 'wr', 'in': 'wrr', 'get': 'wrr', 'put': 'rrr',
+            'native': 'w--r', 'call': 'wra', 'tail-call': 'wra', 'return': 'r',
+            'coroutine': 'wr', 'resume': 'wrr', 'yield': 'wr',
+            'jump': '-', 'jump-if': 'r-', 'jump-unless': 'r-'}
+JUMPS = ['jump', 'jump-if', 'jump-unless']     # their last operand is how far they jump
+for op in ['+', '-', '/', '*', '==', '!=', '<=', '>=', '<', '>']:
+    OPERANDS[op] = 'wrr'
+
+# Decoded instructions.  resolve turns each instruction into a tuple of an
+# integer opcode and its resolved operands, so that Resume can dispatch on
+# the opcode through a table.  The operands stay in the same places, and
+# every operand read is a register -- bytecode loads each variable into a
+# temp before using it -- except the variable a LOAD reads.  'def' comes
+# in three: LOAD a variable into a register, DEF a local from a register,
+# and DEF_GLOBAL a global from one.  Jumps go to the pc they name.  The
+# opcodes before JUMP neither jump nor talk to the REPL, and are run by
+# their function in HANDLERS.
+(ASSIGN, LOAD, DEF, DEF_GLOBAL, INT, STRING, DICT, NULL, LAMBDA,
+ ADD, SUB, MUL, DIV, EQ, NE, LE, GE, LT, GT, ITE,
+ LEN, IN, GET, PUT, TYPE,
+ JUMP, JUMP_IF, JUMP_UNLESS,
+ CALL, TAIL_CALL, RETURN, PRINT, ERROR, NATIVE, COROUTINE, RESUME, YIELD) = range(37)
+OPCODES = {'=': ASSIGN, 'int': INT, 'string': STRING, 'dict': DICT, 'null': NULL, 'lambda': LAMBDA,
+           '+': ADD, '-': SUB, '*': MUL, '/': DIV, '==': EQ, '!=': NE,
+           '<=': LE, '>=': GE, '<': LT, '>': GT, 'ite': ITE,
+           'len': LEN, 'in': IN, 'get': GET, 'put': PUT, 'type': TYPE,
+           'jump': JUMP, 'jump-if': JUMP_IF, 'jump-unless': JUMP_UNLESS,
+           'call': CALL, 'tail-call': TAIL_CALL, 'return': RETURN,
+           'print': PRINT, 'error': ERROR, 'native': NATIVE,
+           'coroutine': COROUTINE, 'resume': RESUME, 'yield': YIELD}
+OPNAMES = dict([(code, name) for name, code in OPCODES.items()])
+OPNAMES.update({LOAD: 'load', DEF: 'def', DEF_GLOBAL: 'def-global'})
+for code, name in OPNAMES.items():     # so variables works on decoded instructions too
+    OPERANDS[code] = OPERANDS[name if code not in (LOAD, DEF_GLOBAL) else 'def']
+
+# the (role, variable) of each variable operand of instruction INST
+def variables(inst):
+    result = []
+    for role, operand in zip(OPERANDS[inst[0]], inst[1:]):
+        if role == 'a':
+            result.extend([('r', name) for name in operand])
+        elif role != '-' and operand is not None:
+            result.append((role, operand))
+    return result
+
+# temps are the variables bytecode makes up
+def isTemp(name):
+    return name[0] == '$'
+
+# allocate registers, numbered from BASE, to the temps of CODE.  a temp
+# lives from its first def to its last use, after which its register is
+# free for the next temp defined -- even by the same instruction, as every
+# instruction reads its operands before it writes its result.  a temp
+# live at the start of a loop lives on to the jump back.  returns
+# ({temp: register}, number of registers)
+def registers(code, base):
+    first, last = {}, {}
+    for i, inst in enumerate(code):
+        for role, name in variables(inst):
+            first.setdefault(name, i)
+            last[name] = i
+    for i, inst in enumerate(code):
+        if inst[0] in JUMPS and inst[-1] < 0:
+            start = i + 1 + inst[-1]
+            for name in last:
+                if first[name] < start <= last[name] < i:
+                    last[name] = i
+    result = {}
+    live = {}           # temps holding on to their registers
+    free = []
+    count = 0
+    for i, inst in enumerate(code):
+        temps = [(role, name) for role, name in variables(inst) if isTemp(name)]
+        for role, name in temps:            # operands read for the last time
+            if role != 'w' and last[name] == i and name in live:
+                free.append(live.pop(name))
+        for role, name in temps:
+            if role == 'w' and name not in result:
+                if free:
+                    register = free.pop()
+                else:
+                    register = base + count
+                    count += 1
+                result[name] = live[name] = register
+        for role, name in temps:            # results never used
+            if role == 'w' and last[name] == i and name in live:
+                free.append(live.pop(name))
+    return result, count
+
+# the number of registers top-level CODE uses
+def registerCount(code):
+    return 1 + max([-1] + [a for inst in code for role, a in variables(inst) if type(a) is int])
+
+# resolve the variables of CODE, run in the frames of the Funs in SCOPES
+# (innermost first; empty for top-level code), with its temps in the
+# registers REGS, and decode its instructions; lambda instructions become
+# (LAMBDA, var, Fun)
+def resolve(code, scopes, regs):
+    def address(name):
+        if isTemp(name):
+            return regs[name]
+        for depth, fun in enumerate(scopes):
+            if name in fun.slots:
+                return fun.slots[name] if depth == 0 else (depth, fun.slots[name])
+        return (len(scopes), name) if scopes else name
+    def target(name):
+        if isTemp(name):
+            return regs[name]
+        return scopes[0].slots[name] if scopes else name
+
+    result = []
+    for inst in code:
+        if inst[0] == 'lambda':
+            params, body = inst[2], inst[3]
+            names = [None, None] + params
+            for i in body:
+                if OPERANDS[i[0]][0] == 'w' and not isTemp(i[1]) and i[1] not in names:
+                    names.append(i[1])
+            bodyRegs, count = registers(body, len(names))
+            fun = Fun(params, None, names + [None] * count)
+            fun.body = resolve(body, [fun] + scopes, bodyRegs)
+            result.append((LAMBDA, target(inst[1]), fun))
+            continue
+        if inst[0] != 'def':
+            new = [OPCODES[inst[0]]]
+        elif isTemp(inst[1]):
+            new = [LOAD]
+        else:
+            new = [DEF if scopes else DEF_GLOBAL]
+        for role, operand in zip(OPERANDS[inst[0]], inst[1:]):
+            if role == 'w':
+                operand = target(operand)
+            elif role in 'ru' and operand is not None:
+                operand = address(operand)
+            elif role == 'a':
+                operand = [address(name) for name in operand]
+            new.append(operand)
+        if inst[0] in JUMPS:
+            new[-1] = len(result) + 1 + new[-1]     # jump to that pc
+        result.append(tuple(new))
+    return result
 
 def print_bytecode(p,indent=0):
     for inst in p:
-        if inst[0] != 'lambda': print " "*4*indent, inst
+        if inst[0] != LAMBDA: print " "*4*indent, (OPNAMES[inst[0]],) + inst[1:]
         else:
-            print " "*4*indent, inst[0:3]
-            print_bytecode(inst[3],indent+1)
+            print " "*4*indent, (OPNAMES[inst[0]], inst[1]), inst[2].argList
+            print_bytecode(inst[2].body,indent+1)
 
 
 # The interpreter   
-class Fun:     # the function: (ret-var, arg list, body)
-    def __init__(self, argList, body):
+UNSET = object()    # the value of a slot not yet defined in its frame
+
+class Fun:     # the function: (arg list, body, names of its frame's slots)
+    def __init__(self, argList, body, names=None):
         self.argList = argList
         self.body = body
+        if names is None:
+            names = [None, None] + argList
+        self.names = names          # the variable in each slot; slots 0 and 1 hold the parent env and the Fun
+        self.slots = dict([(name, i) for i, name in enumerate(names) if i >= 2 and name is not None])
+        self.locals = [UNSET] * (len(names) - 2 - len(argList))
+    def frame(self, parent, args):
+        """ A new frame for a call, with args in the parameter slots """
+        return [parent, self] + args + self.locals
 
 class FunVal:  # function value (a closure): (fun, env)
     def __init__(self, fun, env, coroutine=False):
@@ -143,8 +355,9 @@ def Exec(stmts):
     return Resume(stmts)  # return the last statement's value 
 def ExecFun(closure, args):
     """ Execute a function with arguments args."""
-    env = dict(zip(closure.fun.argList,args))
-    env['__up__'] = closure.env
+    n = len(closure.fun.argList)
+    args = list(args[:n]) + [UNSET] * (n - len(args))
+    env = closure.fun.frame(closure.env, args)
     return Resume(closure.fun.body, env) # return the function's return value
 def ExecFunByName(funName, args):
     """ Execute stmts and then call function with name 'funName'
@@ -157,143 +370,183 @@ def ExecString(code, args):
     global cs164parser
     if not cs164parser:
         cs164grammarFile = './cs164b.grm'
-        cs164parser = parser_generator.makeParser(grammar_parser.parse(open(cs164grammarFile).read()))
+        cs164parser = parser_generator.makeParser(open(cs164grammarFile).read(), 'hybrid')
     env = args
     env['__up__'] = globEnv
     bc = bytecode(desugar(cs164parser.parse(code)))
     Resume(bc[1], env)
 
+# A run-time error in the program; Resume reports it to the REPL and stops
+class ExecError(Exception):
+    pass
+
+# Variables.  env is the current env (a frame or a dict) and regs the
+# registers of the code running in it.
+
+# find the variable called name, starting at env f, a frame or a dict
+def search(name, f):
+    while f is not None:
+        if type(f) is list:
+            slot = f[1].slots.get(name)
+            if slot is not None and f[slot] is not UNSET:
+                return f, slot
+            f = f[0]
+        elif f.has_key(name):
+            return f, name
+        else:
+            f = f["__up__"]
+    return None, None
+
+# the env holding the variable at address a, and its slot (or name) there
+def locate(a, env):
+    if type(a) is int:                  # the common case: the current frame
+        if env[a] is not UNSET:
+            return env, a
+        return search(env[1].names[a], env[0])
+    if type(a) is str:
+        return search(a, env)
+    depth, where = a
+    f = env
+    for i in xrange(depth):
+        f = f[0]
+    if type(where) is str:
+        return search(where, f)
+    if f[where] is not UNSET:
+        return f, where
+    return search(f[1].names[where], f[0])
+
+# the name of the variable at address a, for error messages
+def varName(a, env):
+    if type(a) is str:
+        return a
+    if type(a) is int:
+        return env[1].names[a]
+    depth, where = a
+    if type(where) is str:
+        return where
+    f = env
+    for i in xrange(depth):
+        f = f[0]
+    return f[1].names[where]
+
+def lookup(a, regs, env):
+    if type(a) is int:
+        v = regs[a]
+        if v is not UNSET:
+            return v
+    f, where = locate(a, env)
+    if f is None:
+        raise ExecError("No such variable: " + varName(a, env))
+    return f[where]
+
+def update(a, val, env):
+    f, where = locate(a, env)
+    if f is None:
+        raise ExecError("Can't assign value to uninitialized variable: " + varName(a, env))
+    f[where] = val
+
+def lookupObject(obj, var):
+    if var in obj:
+        return obj[var]
+    elif '__mt' not in obj or not obj['__mt']:
+        raise ExecError("No such attribute %s in %s." % (var, obj))
+    else:
+        return lookupObject(obj['__mt'], var)
+
+# Handlers of the instructions before CALL: handler(e, regs, env)
+def execAssign(e, regs, env):    update(e[1], regs[e[2]], env)
+def execLoad(e, regs, env):      regs[e[1]] = lookup(e[2], regs, env)
+def execDef(e, regs, env):       regs[e[1]] = regs[e[2]]
+def execDefGlobal(e, regs, env): env[e[1]] = regs[e[2]]
+def execConst(e, regs, env):     regs[e[1]] = e[2]    # 164 ints and strings are Python ints and strings
+def execDict(e, regs, env):      regs[e[1]] = {}      # we represent 164 dicts with Python dictionaries
+def execNull(e, regs, env):      regs[e[1]] = None    # represent 164 null with Python's None
+def execLambda(e, regs, env):    regs[e[1]] = FunVal(e[2], env)
+def execAdd(e, regs, env):
+    a, b = regs[e[2]], regs[e[3]]
+    if type(a) == type(b) == type(0):
+        regs[e[1]] = a + b
+    else:
+        regs[e[1]] = unicode(a) + unicode(b)
+def execSub(e, regs, env):       regs[e[1]] = regs[e[2]] - regs[e[3]]
+def execMul(e, regs, env):       regs[e[1]] = regs[e[2]] * regs[e[3]]
+def execDiv(e, regs, env):
+    if regs[e[3]] == 0:
+        raise ExecError("Dividing by zero is a no-no")
+    regs[e[1]] = regs[e[2]] / regs[e[3]]
+def execEq(e, regs, env):        regs[e[1]] = 1 if regs[e[2]] == regs[e[3]] else 0
+def execNe(e, regs, env):        regs[e[1]] = 1 if regs[e[2]] != regs[e[3]] else 0
+def execLe(e, regs, env):        regs[e[1]] = 1 if regs[e[2]] <= regs[e[3]] else 0
+def execGe(e, regs, env):        regs[e[1]] = 1 if regs[e[2]] >= regs[e[3]] else 0
+def execLt(e, regs, env):        regs[e[1]] = 1 if regs[e[2]] < regs[e[3]] else 0
+def execGt(e, regs, env):        regs[e[1]] = 1 if regs[e[2]] > regs[e[3]] else 0
+def execIte(e, regs, env):       regs[e[1]] = regs[e[3]] if regs[e[2]] else regs[e[4]]
+
+# table operations
+def execLen(e, regs, env):
+    l = regs[e[2]]
+    length = 0
+    for i in range(len(l)):
+        if l.has_key(i): length = i + 1
+        else: break
+    regs[e[1]] = length
+def execIn(e, regs, env):        regs[e[1]] = 1 if regs[e[2]] in regs[e[3]] else 0
+def execGet(e, regs, env):       regs[e[1]] = lookupObject(regs[e[2]], regs[e[3]])
+def execPut(e, regs, env):       regs[e[1]][regs[e[2]]] = regs[e[3]]
+
+# not a real function
+def execType(e, regs, env):      regs[e[1]] = str(type(regs[e[2]])).split("'")[1]
+
+HANDLERS = [execAssign, execLoad, execDef, execDefGlobal, execConst, execConst, execDict, execNull, execLambda,
+            execAdd, execSub, execMul, execDiv, execEq, execNe, execLe, execGe, execLt, execGt, execIte,
+            execLen, execIn, execGet, execPut,
+            execType]
+assert len(HANDLERS) == JUMP
+
 # This is the main function of the bytecode interpreter.
-# Error handling is missing from the skeleton.
 def Resume(stmts, env={'__up__': None}, pc=0, callStack=[], fun=None, REPL=None):
     """ Arguments represent the state of the coroutine (as well as of the main program)
         stmts: array of bytecodes, pc: index into stmts where the execution should (re)start
         callStack: the stack of calling context of calls pending in the coroutine
         env: the current environment. """
 
-    def lookup(name):
-        def _lookup(name, env):
-            if env.has_key(name):
-                return env[name]
-            elif env["__up__"]:
-                return _lookup(name, env["__up__"])
-            else:
-                REPL.softError("No such variable: " + name)
-                raise NameError
-        return _lookup(name, env)
-
-    def lookupObject(obj, var):
-        if var in obj:
-            return obj[var]
-        elif '__mt' not in obj or not obj['__mt']:
-            REPL.softError("No such attribute %s in %s." % (var, obj))
-            raise NameError
-        else:
-            return lookupObject(obj['__mt'], var)
-
-    def update(name, val):
-        def _update(name, env, val):
-            if env.has_key(name):
-                env[name] = val
-            elif env["__up__"]:
-                _update(name, env["__up__"], val)
-            else:
-                REPL.softError("Can't assign value to uninitialized variable: " + name)
-                raise NameError
-        _update(name, env, val)
-    def define(name,val):
-        env[name] = val
-    def addScope(parentEnv):
-        " create an empty scope and link it to parentEnv "
-        return {'__up__': parentEnv}
+    # the registers of the code running: the frame itself, in a function,
+    # and a list of their own for top-level code, whose env is a dict
+    regs = env if type(env) is list else [None] * registerCount(stmts)
 
     # This only gets executed if this is a coroutine
     if fun and fun.coroutine:
         stmts, pc, lhsVar, env, callStack = fun.corStack
-        define(lhsVar, fun.corArg)
+        regs = env
+        regs[lhsVar] = fun.corArg
 
     if pc == -1:
         REPL.softError("Attempted to resume a terminated coroutine.")       # this is a coroutine that has ended
         return
 
-    while True:
-
-        e = stmts[pc]
-        pc = pc + 1
-        try:
-            if   e[0] == '=':      update(e[1], lookup(e[2]))
-            elif e[0] == 'dict':   define(e[1], {})  # we represent 164 dicts with Python dictionaries
-            elif e[0] == 'string': define(e[1], e[2])  # we represent 164 strings with Python strings
-            elif e[0] == 'def':    define(e[1], e[2] if type(e[2])==type(1) else lookup(e[2]))
-            elif e[0] == 'print':
-                if lookup(e[1]) != None:
-                    REPL.printLine(str(lookup(e[1])))
-                else:
-                    REPL.printLine("null")
-            elif e[0] == 'error':
-                if lookup(e[1]) != None:
-                    REPL.gracefulExit("Error: " + str(lookup(e[1])), -1)
-                else:
-                    REPL.gracefulExit("Error", -1)
-            elif e[0] == '+':
-                if type(lookup(e[2])) == type(lookup(e[3])) == type(0):
-                    define(e[1], lookup(e[2]) + lookup(e[3]))
-                else:
-                    define(e[1], unicode(lookup(e[2])) + unicode(lookup(e[3])))
-            elif e[0] == '-':      define(e[1], lookup(e[2]) - lookup(e[3]))
-            elif e[0] == '*':      define(e[1], lookup(e[2]) * lookup(e[3]))
-            elif e[0] == '/':
-                if lookup(e[3]) != 0:
-                    define(e[1], lookup(e[2]) / lookup(e[3]))
-                else:
-                    REPL.softError("Dividing by zero is a no-no")
-                    return
-            elif e[0] == '==':     define(e[1], 1 if (lookup(e[2]) == lookup(e[3])) else 0)
-            elif e[0] == '!=':     define(e[1], 1 if (lookup(e[2]) != lookup(e[3])) else 0)
-            elif e[0] == '<=':     define(e[1], 1 if (lookup(e[2]) <= lookup(e[3])) else 0)
-            elif e[0] == '>=':     define(e[1], 1 if (lookup(e[2]) >= lookup(e[3])) else 0)
-            elif e[0] == '<':      define(e[1], 1 if (lookup(e[2]) < lookup(e[3])) else 0)
-            elif e[0] == '>':      define(e[1], 1 if (lookup(e[2]) > lookup(e[3])) else 0)
-            elif e[0] == 'ite':    define(e[1], lookup(e[3]) if lookup(e[2]) else lookup(e[4]))
-            elif e[0] == 'lambda': define(e[1], FunVal(Fun(e[2],e[3]),env) )
-            elif e[0] == 'null':   define(e[1], None) # represent 164 null with Python's None 
-
-            # table operations
-            elif e[0] == 'len':
-                l = lookup(e[2])
-                length = 0
-                for i in range(len(l)):
-                    if l.has_key(i): length = i + 1
-                    else: break
-                define(e[1], length)
-            elif e[0] == 'in':      define(e[1], 1 if (lookup(e[2]) in lookup(e[3])) else 0)
-            elif e[0] == 'get':     define(e[1], lookupObject(lookup(e[2]), lookup(e[3])))
-            elif e[0] == 'put':     lookup(e[1])[lookup(e[2])] = lookup(e[3])
-
-            # not a real function
-            elif e[0] == 'type':
-                toType = e[2] if type(e[2])==type(1) else lookup(e[2])
-                define(e[1], str(type(toType)).split("'")[1])
-
-            # support native calls to the Python API
-            elif e[0] == 'native':
-                args = lookup(e[4]) if e[4] else None
-                exec 'import ' + e[2] in locals()     # import the relevant library
-                try:
-                    ret = eval(e[2] + '.' + e[3])(**args) if args else eval(e[2] + '.' + e[3])()
-                except Exception, e:
-                    REPL.softError("Native call failed with error: \n    " + str(e))       # Native call failed; exit "gracefully" (aka DIE IN A FIRE)
-                    return
-                if type(ret) == type(()) or type(ret) == type([]):
-                    ret = dict(zip(range(len(ret)), ret))
-                define(e[1], ret)
+    handlers = HANDLERS
+    try:
+        while True:
+            e = stmts[pc]
+            pc = pc + 1
+            op = e[0]
+            if op < JUMP:
+                handlers[op](e, regs, env)
+
+            # branches
+            elif op == JUMP_UNLESS:
+                if not regs[e[1]]: pc = e[2]
+            elif op == JUMP:
+                pc = e[1]
+            elif op == JUMP_IF:
+                if regs[e[1]]: pc = e[2]
 
             # calls and returns
-            elif e[0] == 'call':
+            elif op == CALL or op == TAIL_CALL:
 
                 lhsVar = e[1]
                 # decompose the function value
-                func    = lookup(e[2])
+                func    = regs[e[2]]
 
                 if not isinstance(func, FunVal):
                     REPL.softError("Can't call that; not a function.")   # not a function :(
@@ -307,40 +560,58 @@ def Resume(stmts, env={'__up__': None}, pc=0, callStack=[], fun=None, REPL=None)
                     REPL.softError("Expected %d args, got %d." % (len(func.fun.argList), len(e[3])))   # wrong number of args
                     return
 
-                argList = []
-                for i in range(len(func.fun.argList)):
-                    argList.append(lookup(e[3][i]))
-
-                # push the calling context onto the call stack; we'll restore to it when the call returns
-                callStack.append((stmts,pc,lhsVar,env))
-                # prepare the enviroment for the callee function
-                env = addScope(fenv)    # create a new scope; connect it to the scope to the env of the
+                argList = [regs[a] for a in e[3]]
 
-                # copy saved arg values into the current frame
-                for i in range(len(func.fun.argList)):
-                    env[func.fun.argList[i]] = argList[i]
+                # push the calling context onto the call stack; we'll restore to it when the call returns.
+                # a tail call has nothing left to do but return, so the callee returns to our caller instead
+                if op == CALL:
+                    callStack.append((stmts,pc,lhsVar,env,regs))
+                # prepare the enviroment for the callee function: a new frame, connected to the
+                # env of the function, with the saved arg values in it; make it the new env
+                env = regs = func.fun.frame(fenv, argList)
 
-                # function, and make it the new env
                 # jump to body of the callee 
                 stmts = fbody  # each function has own list of statements (the body)
                 pc = 0         # and its body starts at index 0
 
-            elif e[0] == 'return':
+            elif op == RETURN:
                 if len(callStack) == 0:
                     # the interpreter base routine has just terminated.
                     if fun:     # so set pc:impossible.
                         fun.corStack = (fun.corStack[0], -1) + fun.corStack[2:]
-                    return lookup(e[1])
+                    return regs[e[1]]
                 # top of call stack stores the the caller's context that we need to restore
-                ret = lookup(e[1])
-                stmts,pc,lhsVar,cenv = callStack.pop()
-                # restore the environment of the call
-                env = cenv
-                define(lhsVar, ret)
+                ret = regs[e[1]]
+                stmts,pc,lhsVar,env,regs = callStack.pop()
+                regs[lhsVar] = ret
 
-            elif e[0] == 'coroutine':
+            elif op == PRINT:
+                if regs[e[1]] != None:
+                    REPL.printLine(str(regs[e[1]]))
+                else:
+                    REPL.printLine("null")
+            elif op == ERROR:
+                if regs[e[1]] != None:
+                    REPL.gracefulExit("Error: " + str(regs[e[1]]), -1)
+                else:
+                    REPL.gracefulExit("Error", -1)
 
-                funcdef = lookup(e[2])
+            # support native calls to the Python API
+            elif op == NATIVE:
+                args = regs[e[4]] if e[4] is not None else None
+                exec 'import ' + e[2] in locals()     # import the relevant library
+                try:
+                    ret = eval(e[2] + '.' + e[3])(**args) if args else eval(e[2] + '.' + e[3])()
+                except Exception, e:
+                    REPL.softError("Native call failed with error: \n    " + str(e))       # Native call failed; exit "gracefully" (aka DIE IN A FIRE)
+                    return
+                if type(ret) == type(()) or type(ret) == type([]):
+                    ret = dict(zip(range(len(ret)), ret))
+                regs[e[1]] = ret
+
+            elif op == COROUTINE:
+
+                funcdef = regs[e[2]]
 
                 # error check - needs to be a function
                 if not isinstance(funcdef, FunVal) or funcdef.coroutine:
@@ -348,20 +619,20 @@ def Resume(stmts, env={'__up__': None}, pc=0, callStack=[], fun=None, REPL=None)
                     return
 
                 # copy the env, so we don't clobber the lambda
-                func = FunVal(funcdef.fun, addScope(funcdef.env), True)
+                func = FunVal(funcdef.fun, funcdef.fun.frame(funcdef.env, [UNSET] * len(funcdef.fun.argList)), True)
 
                 # (stmts, pc, lhsVar, env, callStack)
-                func.corStack = (func.fun.body, 0, func.fun.argList[0], func.env, [])
+                func.corStack = (func.fun.body, 0, func.fun.slots[func.fun.argList[0]], func.env, [])
 
                 # In Soviet Russia, environment saves YOU!
-                define(e[1], func)
+                regs[e[1]] = func
 
-            elif e[0] == 'resume':
+            elif op == RESUME:
                 # The second argument to resume is the argument it passes to the coroutine.
                 # You must ensure that you handle the case where you try to resume
                 #  a coroutine that has already ended.
 
-                co = lookup(e[2])
+                co = regs[e[2]]
 
                 # error check
                 if not isinstance(co, FunVal) or not co.coroutine:
@@ -373,10 +644,10 @@ def Resume(stmts, env={'__up__': None}, pc=0, callStack=[], fun=None, REPL=None)
                     REPL.softError("Can't resume ourselves...")         # SO INTENSE
                     return
 
-                co.corArg = lookup(e[3])
-                define(e[1], Resume(co.fun.body, co.env, fun=co, REPL=REPL))
+                co.corArg = regs[e[3]]
+                regs[e[1]] = Resume(co.fun.body, co.env, fun=co, REPL=REPL)
 
-            elif e[0] == 'yield':
+            elif op == YIELD:
                 # The one parameter is an argument passed to whomever resumed the coroutine.
 
                 # WE GET COROUTINE
@@ -387,29 +658,35 @@ def Resume(stmts, env={'__up__': None}, pc=0, callStack=[], fun=None, REPL=None)
 
                     # MOVE LHSVAR
                     # FOR GREAT RETURN
-                    return lookup(e[2])
+                    return regs[e[2]]
                 else:
                     REPL.softError("Not in a coroutine, can't yield!")       # don't yield the main! DON'T YIELD THE MAIN!
                     return
 
             else: raise SyntaxError("Illegal instruction: %s " % str(e))
-        except TypeError, e:
-            REPL.softError("Type error: " + str(e))
-            return
-        except NameError:
-            REPL.exec_fail = True
-            return
+    except TypeError, e:
+        REPL.softError("Type error: " + str(e))
+        return
+    except ExecError, e:
+        REPL.softError(str(e))
+        return
     return NeverReached
 
 def desugar(ast):
 
+    # if and while compile to jumps (see bytecode), their bodies inline;
+    # a body that defs variables still gets a scope of its own, called
+    # each time it runs, so they stay local to it
+    def scoped(body):
+        if body and [s for s in body if s[0] == 'def']:
+            return [('exp', ('call', ('lambda', [], body), []))]
+        return body
+
     def desugarIf(e):
-        thenclause = ('lambda', [], [('exp', ('lambda', [], e[2]))])
-        elseclause = ('lambda', [], [('exp', ('lambda', [], e[3] if e[3] else [('exp', ('null',))]))])      # allow for missing else case
-        return desugar(('call', ('call', ('ite', e[1], thenclause, elseclause), []), []))
+        return ('if', desugar(e[1]), scoped(desugar(e[2])), scoped(desugar(e[3])))
 
     def desugarWhile(e):
-        return desugar(('call', ('lambda', [], [('def', '#while', ('lambda', [], [('if', e[1], [('exp', ('call', ('lambda', [], e[2]), [])), ('exp', ('call', ('var', '#while'), []))], None)])), ('exp', ('call', ('var', '#while'), []))]), []))
+        return ('while', desugar(e[1]), scoped(desugar(e[2])))
 
     def desugarFor(e):
         return desugar(
@@ -465,16 +742,6 @@ def desugar(ast):
             )
         )
 
-    def desugarAnd(e):
-        trueCase = [('exp', ('int-lit', 1))]
-        falseCase = [('exp', ('int-lit', 0))]
-        return desugar(('call', ('lambda', [], [('if', e[1], [('if', e[2], trueCase, falseCase)], falseCase)]), []))
-
-    def desugarOr(e):
-        trueCase = [('exp', ('int-lit', 1))]
-        falseCase = [('exp', ('int-lit', 0))]
-        return desugar(('call', ('lambda', [], [('if', e[1], trueCase, [('if', e[2], trueCase, falseCase)])]), []))
-
     def desugarDict(e):
         if e[1] == []:
             return e
@@ -577,8 +844,6 @@ def desugar(ast):
         if   ast[0] == 'if':        return desugarIf(ast)
         elif ast[0] == 'while':     return desugarWhile(ast)
         elif ast[0] == 'for':       return desugarFor(ast)
-        elif ast[0] == '||':        return desugarOr(ast)
-        elif ast[0] == '&&':        return desugarAnd(ast)
         elif ast[0] == 'dict-lit':  return desugarDict(ast)
         elif ast[0] == 'comprehension':  return desugarComp(ast)
         elif ast[0] == 'objcall':   return desugarObjCall(ast)
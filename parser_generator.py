@@ -3,7 +3,10 @@
 #
 # $Id: parser_generator.py,v 1.7 2007/04/16 06:54:11 cgjones Exp $
 import grammar, grammar_parser, re, sys, types, util, string, pprint, os.path
+import sre_parse, sre_constants, hashlib, marshal, cPickle, time, json
 from collections import defaultdict
+from itertools import islice
+from array import array
 
 ##-----------------------------------------------------------------------------
 ## Module interface
@@ -13,7 +16,9 @@ def makeRecognizer (gram, type='earley'):
     '''Construct and return a "recognizer" of GRAM.
 
     A recognizer is an object with a method recognize(inp), returning
-    True if INP is a valid string in GRAM, and False otherwise.
+    True if INP is a valid string in GRAM, and False otherwise.  It runs
+    only the recognizing part of the Earley algorithm (see
+    EarleyParser.recognize), so it is far cheaper than parsing.
     '''
     class Recognizer:
         def __init__ (self, parser):
@@ -35,11 +40,74 @@ def makeParser (gram, type='earley'):
 
     A parser is an object with a method parse(inp), returning the AST
     constructed from the parse tree of INP by the semantic actions in GRAM.
+
+    GRAM is either a grammar.Grammar or the text of a grammar file; given
+    the text, the preprocessed grammar comes from the on-disk cache when it
+    can (see loadGrammar).
     '''
-    if type == 'earley':
-        return EarleyParser (gram)
-    else:
+    if type not in ('earley', 'lalr', 'hybrid'):
         raise TypeError, 'Unknown parser type specified'
+    if isinstance (gram, basestring):
+        parser = EarleyParser (None, loadGrammar (gram))
+    else:
+        parser = EarleyParser (gram)
+    if type == 'earley':
+        return parser
+    tables = None
+    if isinstance (gram, basestring):
+        tables = cached ('lalr', gram, lambda: LALRParser.buildTables (parser.grammar))
+    return LALRParser (parser, fallback=(type == 'hybrid'), tables=tables)
+
+
+# Directory of preprocessed grammars, or None to disable the cache.  Bump
+# CACHE_VERSION whenever the format of EarleyParser.compile or of
+# LALRParser.buildTables changes.
+GRAMMAR_CACHE = os.path.join (os.path.dirname (os.path.abspath (__file__)), '.grammar-cache')
+CACHE_VERSION = 10
+
+def loadGrammar (text):
+    '''Return EarleyParser.compile of the grammar TEXT, reading it from
+    GRAMMAR_CACHE if this text was compiled before and saving it there if
+    not (see cached).
+    '''
+    return cached ('earley', text, lambda: EarleyParser.compile (grammar_parser.parse (text)))
+
+def cached (kind, text, build):
+    '''Return the KIND of data built from the grammar TEXT by BUILD(),
+    reading it from GRAMMAR_CACHE if it was built before and saving it
+    there if not.  Entries are keyed by a hash of KIND and TEXT (and of the
+    cache version and Python version), so an edited grammar simply gets a
+    new entry.  A missing, unreadable or unwritable cache only costs the
+    build.
+    '''
+    if GRAMMAR_CACHE is None:
+        return build ()
+
+    key = hashlib.sha1 ('%d\n%s\n%s\n%s'% (CACHE_VERSION, sys.version, kind, text)).hexdigest ()
+    path = os.path.join (GRAMMAR_CACHE, key + '.pickle')
+    try:
+        f = open (path, 'rb')
+        try:
+            return cPickle.load (f)
+        finally:
+            f.close ()
+    except Exception:
+        pass
+
+    data = build ()
+    try:
+        if not os.path.isdir (GRAMMAR_CACHE):
+            os.makedirs (GRAMMAR_CACHE)
+        tmp = '%s.%d'% (path, os.getpid ())   # rename, so readers never see half a file
+        f = open (tmp, 'wb')
+        try:
+            cPickle.dump (data, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close ()
+        os.rename (tmp, path)
+    except (IOError, OSError):
+        pass
+    return data
 
 ##-----------------------------------------------------------------------------
 
@@ -52,41 +120,469 @@ class saObject(): #synthesized attribute object
         if not self.children: #this is a terminal, so it has no children to recurse over
             return self
         return saObject(val = self.action(*tuple([self]+[child.act() for child in self.children])))
+
+##-----------------------------------------------------------------------------
+## Lexer
+##
+class Lexer:
+    '''A longest-match tokenizer over the (regex, lhs) list built by
+    EarleyParser.preprocess.
+
+    Rather than running every terminal regex at every position, the lexer
+    looks at the character under the cursor and runs a single combined
+    regex made of only the terminals that can start with that character.
+    Each terminal sits in its own lookahead group, (?=(regex)), so one
+    match() call reports the match of every candidate with exactly the
+    semantics it would have on its own; the longest one wins, and ties go
+    to the terminal listed first, as before.  A terminal with a
+    backreference, like /(['"]).*?\1/, can't be wrapped without
+    renumbering its groups, so it is matched on its own, in its turn.
+    '''
+
+    MAX_GROUPS = 90     # python's sre caps the groups in a single pattern
+
+    def __init__ (self, terminals):
+        '''Build the dispatch table for TERMINALS, a list of (regex, lhs).
+        The combined regexes are only compiled when a character first
+        needs them.'''
+        self.terminals = terminals
+        self.__combined = {}            # candidate tuple -> [(regex, [(group, lhs)])]
+        self.table = {}                 # character -> combined regexes, filled by scan
+
+        # terminals matched on their own rather than in a combined regex
+        self.alone = [Lexer.refersBack (regex) for regex, lhs in terminals]
+
+        firsts = [Lexer.firstChars (regex) for regex, lhs in terminals]
+
+        # bucket every character by the terminals that may start with it;
+        # anything else (i.e. unicode) gets the non-ascii bucket
+        self.candidates = []
+        for c in xrange (128):
+            self.candidates.append (tuple ([i for i, first in enumerate (firsts)
+                                            if first is None or c in first]))
+        self.other = tuple ([i for i, first in enumerate (firsts)
+                             if first is None or max (first) >= 128])
+
+        # at the end of input only nullable terminals can match
+        self.atEnd = tuple ([i for i, (regex, lhs) in enumerate (terminals)
+                             if regex.match ('')])
+
+    def __combine (self, cands):
+        '''Return the list of [(regex, [(group, lhs)])] that together try
+        the terminals with indices CANDS, in order.'''
+        if cands in self.__combined:
+            return self.__combined[cands]
+
+        try:
+            chunks = self.__chunk (cands, Lexer.MAX_GROUPS)
+        except re.error:                # e.g. clashing named groups
+            chunks = self.__chunk (cands, 0)
+
+        self.__combined[cands] = chunks
+        return chunks
+
+    def __chunk (self, cands, maxGroups):
+        '''Split the terminals with indices CANDS into combined regexes of
+        at most MAXGROUPS groups each (but at least one terminal).  A
+        terminal to be matched alone is a chunk of its own, its group 0
+        being the whole match.'''
+        chunks = []
+        pieces, groups, size, flags = [], [], 0, None
+        for i in cands:
+            regex, lhs = self.terminals[i]
+            if pieces and (self.alone[i] or regex.flags != flags
+                           or size + regex.groups + 1 > maxGroups):
+                chunks.append ((Lexer.__compile (pieces, flags), groups))
+                pieces, groups, size = [], [], 0
+            if self.alone[i]:
+                chunks.append ((regex, [(0, lhs)]))
+                continue
+            flags = regex.flags
+            pieces.append (regex.pattern)
+            groups.append ((size + 1, lhs))
+            size += regex.groups + 1
+        if pieces:
+            chunks.append ((Lexer.__compile (pieces, flags), groups))
+        return chunks
+
+    @staticmethod
+    def __compile (patterns, flags):
+        return re.compile (''.join (['(?:(?=(%s))|)'% (p) for p in patterns]),
+                           flags)
+
+    def scan (self, inp, pos):
+        '''Return (lhs, end) for the longest match in INP at POS.  LHS is
+        None for 'ignore' tokens and 0 if nothing matches at all.'''
+        if pos < len (inp):
+            try:
+                chunks = self.table[inp[pos]]
+            except KeyError:
+                chunks = self.table[inp[pos]] = self.__combine (
+                    self.__candidates (inp, pos))
+        else:
+            chunks = self.__combine (self.atEnd)
+
+        matchLHS = 0
+        matchEnd = -1
+        for regex, groups in chunks:
+            match = regex.match (inp, pos)
+            if match is None:           # only a terminal matched alone can fail
+                continue
+            regs = match.regs
+            for group, lhs in groups:
+                end = regs[group][1]
+                if end > matchEnd:
+                    matchLHS = lhs
+                    matchEnd = end
+        return matchLHS, matchEnd
+
+    def __candidates (self, inp, pos):
+        '''Return the indices of the terminals that may match INP at POS.'''
+        if pos == len (inp):
+            return self.atEnd
+        c = ord (inp[pos])
+        return self.candidates[c] if c < 128 else self.other
+
+    def tokenize (self, inp):
+        '''Return the tokenized version of INP, a sequence of
+        (token, lexeme) pairs.
+        '''
+        tokens = []
+        pos = 0
+
+        while True:
+            matchLHS, matchEnd = self.scan (inp, pos)
+
+            if pos == len (inp):
+                if matchLHS:  tokens.append ((matchLHS, inp[pos:matchEnd]))
+                break
+            elif pos == matchEnd:       # 0-length match
+                raise NameError, pos
+            elif matchLHS is None:      # 'Ignore' tokens
+                pass
+            elif matchLHS:              # Valid token
+                tokens.append ((matchLHS, inp[pos:matchEnd]))
+            else:                       # no match
+                raise NameError, str(pos) + ": " + str(inp[max(pos-5,0):min(pos+5,len(inp))])
+
+            pos = matchEnd
+
+        return tokens
+
+    ##---  STATIC  ------------------------------------------------------------
+
+    @staticmethod
+    def refersBack (regex):
+        '''Return True if REGEX has a backreference to one of its groups
+        (\1, (?P=name) or (?(1)...)).'''
+        stack = [sre_parse.parse (regex.pattern, regex.flags)]
+        while stack:
+            item = stack.pop ()
+            if isinstance (item, sre_parse.SubPattern):
+                for op, av in item:
+                    if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                        return True
+                    stack.append (av)
+            elif isinstance (item, (tuple, list)):
+                stack.extend (item)
+        return False
+
+    @staticmethod
+    def firstChars (regex):
+        '''Return the set of character codes that a match of REGEX can
+        start with, or None if it may start with anything or match the
+        empty string.  The set errs on the large side.'''
+        if regex.flags & (re.LOCALE | re.UNICODE):
+            return None                 # character classes leave the table
+        first, nullable = Lexer.__first (sre_parse.parse (regex.pattern, regex.flags))
+        if nullable or first is None:
+            return None
+        if regex.flags & re.IGNORECASE:
+            first = first | set ([ord (chr (c).swapcase ()) for c in first])
+        return first
+
+    @staticmethod
+    def __first (seq):
+        '''Return (first, nullable?) of the parsed regex sequence SEQ.'''
+        first = set ()
+        for op, av in seq:
+            if op in (sre_constants.AT, sre_constants.ASSERT,
+                      sre_constants.ASSERT_NOT):
+                continue                # zero-width; look past it
+            elif op == sre_constants.LITERAL:
+                return first | set ([av]), False
+            elif op in (sre_constants.NOT_LITERAL, sre_constants.IN,
+                        sre_constants.ANY):
+                chars = Lexer.__charset (op, av)
+                if chars is None:  return None, False
+                return first | chars, False
+            elif op == sre_constants.SUBPATTERN:
+                sub, nullable = Lexer.__first (av[-1])
+            elif op == sre_constants.BRANCH:
+                sub, nullable = set (), False
+                for alt in av[1]:
+                    altFirst, altNullable = Lexer.__first (alt)
+                    if altFirst is None:  return None, False
+                    sub |= altFirst
+                    nullable = nullable or altNullable
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                sub, nullable = Lexer.__first (av[2])
+                nullable = nullable or av[0] == 0
+            else:                       # backreferences and such
+                return None, False
+
+            if sub is None:  return None, False
+            first |= sub
+            if not nullable:  return first, False
+        return first, True
+
+    @staticmethod
+    def __charset (op, av):
+        '''Return the set of character codes matched by the single
+        character op OP, or None if it cannot be enumerated.'''
+        if op == sre_constants.ANY:
+            return None
+        if op == sre_constants.NOT_LITERAL:
+            items, negate = [(sre_constants.LITERAL, av)], True
+        else:
+            items, negate = av, False
+
+        chars = set ()
+        for iop, iav in items:
+            if iop == sre_constants.NEGATE:
+                negate = True
+            elif iop == sre_constants.LITERAL:
+                chars.add (iav)
+            elif iop == sre_constants.RANGE:
+                chars.update (xrange (min (iav[0], 256), min (iav[1], 256) + 1))
+            elif iop == sre_constants.CATEGORY:
+                cat = Lexer.CATEGORIES.get (iav)
+                if cat is None:  return None
+                chars.update ([c for c in xrange (256) if cat.match (chr (c))])
+            else:
+                return None
+        if negate:
+            return None
+        return chars
+
+    # the negated categories also match characters beyond 255, so they are
+    # left out and treated like any other unknown class
+    CATEGORIES = {
+        sre_constants.CATEGORY_DIGIT: re.compile (r'\d'),
+        sre_constants.CATEGORY_SPACE: re.compile (r'\s'),
+        sre_constants.CATEGORY_WORD: re.compile (r'\w'),
+    }
+
+##-----------------------------------------------------------------------------
 ## Earley Parser
 ##
+class EarleySet (object):
+    '''The edges of an Earley chart that end at one input position.  Edges
+    are integers; see EarleyParser.parse.'''
+
+    __slots__ = ('edges', 'complete', 'symbols', 'leftmost', 'inProgress', 'waiting')
+
+    def __init__ (self):
+        self.edges = {}                 # edge -> back pointer
+        self.complete = array ('l')     # complete edges, in insertion order
+        self.symbols = {}               # src*NR+rule -> the complete edge kept for (src,LHS)
+        self.leftmost = {}              # complete edge -> its first child's key, for %left
+        self.inProgress = array ('l')   # in-progress edges, in insertion order
+        self.waiting = {}               # symbol after the dot -> array of in-progress edges
+
+class ParseStats (object):
+    '''What one run of EarleyParser.parse did, collected when the parser's
+    collectStats is set.  Edges inserted and wall-clock seconds are broken
+    down by phase: ADVANCE over a token (scan), PREDICT (predict, which
+    includes stepping over nullable nonterminals) and COMPLETE (complete),
+    and then the semantic actions (sdt).
+    '''
+
+    def __init__ (self):
+        self.tokens = 0                 # tokens parsed
+        self.items = {'scan': 0, 'predict': 0, 'complete': 0}
+        self.time = {'scan': 0.0, 'predict': 0.0, 'complete': 0.0, 'sdt': 0.0}
+        self.wallTime = 0.0             # seconds spent in parse, not waiting for input
+        self.edgesTried = 0             # addEdge calls
+        self.predictionsAvoided = 0     # see EarleyParser.lookahead
+        self.disambiguations = {'calls': 0, 'new': 0, 'old': 0, 'ambiguous': 0, 'unresolved': 0}
+        self.chartSizes = []            # edges in the chart at each position
+        self.chartBytes = 0             # estimated size of the chart, at its largest
+        self.pruned = 0                 # times the chart was pruned
+
+    def asDict (self):
+        '''Return the statistics as a dict, keyed by attribute name.'''
+        return dict (self.__dict__)
+
+    # The phases of a parse are timed and counted by wrapping the functions
+    # that do them, so that without statistics none of this costs anything.
+
+    def timed (self, parser, f, phase):
+        '''Return F, wrapped to add the time it takes to PHASE, and the
+        edges PARSER adds meanwhile to the items of PHASE.'''
+        def g (*args):
+            added, start = parser.edgesAdded, time.time ()
+            result = f (*args)
+            self.time[phase] += time.time () - start
+            if phase in self.items:
+                self.items[phase] += parser.edgesAdded - added
+            return result
+        return g
+
+    def counted (self, disambiguate, new):
+        '''Return DISAMBIGUATE, wrapped to count its outcomes; NEW is
+        the choice of the new edge.'''
+        def g (e1, bp1, e2):
+            choice, ambiguous, resolved = result = disambiguate (e1, bp1, e2)
+            outcomes = self.disambiguations
+            outcomes['calls'] += 1
+            outcomes['new' if choice == new else 'old'] += 1
+            outcomes['ambiguous'] += ambiguous
+            outcomes['unresolved'] += not resolved
+            return result
+        return g
+
+    def resume (self):
+        '''Note that the parse is running again, after waiting for input.'''
+        self.resumed = time.time ()
+
+    def pause (self, parser, inp, chart, dropped, final):
+        '''Bring the statistics up to date before the parse yields or
+        raises: PARSER's counters and the tokens of INP, and if FINAL, as
+        the parse is over, the figures of CHART and DROPPED.'''
+        self.wallTime += time.time () - self.resumed
+        self.tokens = len (inp)
+        self.edgesTried = parser.edgesTried
+        self.predictionsAvoided = parser.predictionsAvoided
+        if final:
+            self.chartSizes = [len (S.edges) for S in chart]
+            self.chartBytes = max (self.chartBytes, ParseStats.sizeOf (chart, dropped))
+        del self.resumed
+
+    def dump (self, f=sys.stdout):
+        '''Write the statistics to F as a JSON object.'''
+        json.dump (self.asDict (), f, sort_keys=True)
+        f.write ('\n')
+
+    @staticmethod
+    def sizeOf (chart, dropped):
+        '''Estimate the bytes taken by CHART, a list of EarleySets, and
+        DROPPED, the back pointers of the edges disambiguation removed.'''
+        intSize = sys.getsizeof (sys.maxint)    # an edge or back pointer
+        size = sys.getsizeof (chart) + sys.getsizeof (dropped)
+        size += len (dropped) * (sys.getsizeof ((0, 0)) + 2 * intSize)
+        seen = set ()                   # pruned sets share their tables
+        for S in chart:
+            for table in (S, S.edges, S.complete, S.symbols, S.leftmost, S.inProgress, S.waiting):
+                if id (table) not in seen:
+                    seen.add (id (table))
+                    size += sys.getsizeof (table)
+            size += sum ([sys.getsizeof (edges) for edges in S.waiting.itervalues ()])
+            size += 2 * intSize * (len (S.edges) + len (S.symbols) + len (S.leftmost))
+        return size
+
 class EarleyParser:
     '''A parser implementing the Earley algorithm.'''
 
-    def __init__ (self, gram):
-        '''Create a new Earley parser.'''
+    PRUNED = EarleySet ()           # stands in for the sets pruneChart empties
+
+    def __init__ (self, gram, compiled=None):
+        '''Create a new Earley parser for GRAM, or from COMPILED, the
+        result of EarleyParser.compile.'''
+        if compiled is None:
+            compiled = EarleyParser.compile (gram)
+        (gram, self.terminals, self.invRenamedTerminals, self.lexer,
+         (self.nullable, self.nullProductions, self.predictions, self.starts),
+         (self.itemProd, self.itemSym, self.itemLHS, self.firstItem),
+         actions, self.reductions) = compiled
         self.grammar = gram
-        self.terminals, self.invRenamedTerminals = EarleyParser.preprocess (gram)
+        EarleyParser.bindSemantFuncs (gram, marshal.loads (actions))
+        self.ruleNumbers = dict ([(rule.lhs, n) for n, rule in enumerate (gram.rules)])
+        self.itemRule = [lhs and self.ruleNumbers[lhs] for lhs in self.itemLHS]
+        self.predictItems = dict ([(M, [self.firstItem[D] for D in productions])
+                                   for M, productions in self.predictions.iteritems ()])
+        self.predictSymbols = dict ([(M, set ([D.LHS for D in productions]))
+                                     for M, productions in self.predictions.iteritems ()])
+        self.predictLookahead = dict ([(M, self.lookaheadItems (productions))
+                                       for M, productions in self.predictions.iteritems ()])
+        self.predictTokens = dict ([(M, frozenset (byToken))
+                                    for M, (byToken, null) in self.predictLookahead.iteritems ()])
+        self.expectedTokens = {}    # (symbols waited for, predictions deferred) -> tokens, see parse
         self.ambiguous = False      # status vars for each run of the parser
         self.resolved = True        # more status
+        self.edgesTried = 0         # addEdge calls in the last parse
+        self.edgesAdded = 0         # edges actually inserted
+        self.passes = 0             # COMPLETE/PREDICT rounds, over all positions
+        self.predictionsAvoided = 0 # predicted items left out by the lookahead
 
         self.subparser = None       # for later...
         self.parsedepth = 0         # how many parsers in are we?
 
         self.debug = False
         self.drawGraph = False
+        self.engine = 'worklist'        # or 'fixpoint', the original COMPLETE/PREDICT loop
+        self.predictionTables = True    # predict from the analysis tables (always on for 'worklist')
+        self.lookahead = True           # ... only the items that can start with the next token
+        self.collectStats = False       # fill in stats on each parse
+        self.pruneEvery = 100000        # edges added between prunings of the chart, or None
+        self.stats = None               # ParseStats of the last parse, if collectStats
+
+    def lookaheadItems (self, productions):
+        '''Return the items predicted for PRODUCTIONS, a prediction closure,
+        by the next token: the pair ({ token : [ items ] }, [ items ]) of the
+        items of the productions that token can start, and the items for
+        any other token.  Productions deriving the empty string are kept
+        for every token; they complete on the spot.
+        '''
+        null = [production for production in productions
+                if all ([sym in self.nullable for sym in production.RHS])]
+        tokens = set ()
+        for production in productions:
+            tokens |= self.starts[production]
+        byToken = {}
+        for token in tokens:
+            byToken[token] = [self.firstItem[production] for production in productions
+                              if token in self.starts[production] or production in null]
+        return byToken, [self.firstItem[production] for production in null]
 
     def parse(self):
-        # The graph is partioned by (destination,completenessStatus) of edges.
-        # The graph is thus a dictionary with the key (dst,complete).
-        # Each key maps to a pair consisting of a list of edges as well as a set of edges.
-        # Both the list and the set keep the same set of edges.  We use both so that we can modify
-        # the set of edges while iterating over it.  While a list data structure can be modified
-        # during iteration, it cannot be tested for membership as fast as the set.
-        # Hence we use it together with a set. 
-        # See the pattern below for illustration of how we use the set and list in tandem.
-
-        # defaultdict is like a dictionary that provides a default value when key is not present
-        graph = defaultdict(lambda: ([],set()))
-        childrenOfEdges = {}        # edge -> (child, subEdge())
-
-        # status of edge is either complete or inProgress
-        complete = 0
-        inProgress = 1
+        # The chart is a list of EarleySets, one per input position j, each
+        # holding the edges (i,j,N -> alpha . beta) that end at j.  Inside a
+        # set, an edge is the integer i*NI+item, where item numbers the dotted
+        # production N -> alpha . beta (see numberItems) and NI is the number
+        # of items, so edges hash and compare as plain ints.  The items of a
+        # production are numbered in order of the dot, so the edge that an
+        # edge e was advanced from is e-1, in some earlier set.
+        #
+        # Each edge maps to a back pointer telling where it came from:
+        #   mid*NI      e-1 in set mid, advanced over the token inp[mid]
+        #   mid*NI+c    e-1 in set mid, advanced over the complete edge
+        #               mid*NI+c of set j (the dot moved over c's LHS)
+        #   -1          nothing; the dot is at the start
+        #
+        # Together the edges and back pointers make up a binarized shared
+        # packed parse forest: complete edges are the symbol nodes and
+        # in-progress edges the intermediate nodes, each with the single
+        # packed node (left sibling e-1, right child) its back pointer names.
+        # Subtrees are shared by every edge that points at them, and
+        # disambiguation keeps one packed node per symbol node (see addEdge).
+        #
+        # Each line sent in is either its tokens or its text.  Text is lexed
+        # on demand, a token at a time, once the chart has got to it (see
+        # lexToken), into the tokens the batch tokenizer would give.
+        chart = []
+        dropped = {}                # (j,edge) -> back pointer, for edges removed by disambiguation
+        agenda = array('l')         # edges added to the current set, in order
+
+        NI = len(self.itemProd)
+        itemProd, itemSym, itemLHS = self.itemProd, self.itemSym, self.itemLHS
+        firstItem = self.firstItem
+
+        # Complete edges are also indexed by the symbol node (src,LHS) they
+        # derive, numbered src*NR+rule, so that a competing derivation is
+        # found with one lookup.
+        NR = len(self.ruleNumbers)
+        itemRule, ruleNumbers = self.itemRule, self.ruleNumbers
 
         # edge picked by disambiguation
         NEW = 1
@@ -96,110 +592,266 @@ class EarleyParser:
         ### HELPER FUNCTIONS ###
         ########################
 
-        # return (list,set) of edges 
-        def edgesIncomingTo(dst,status):
-            key = (dst,status)
-            return graph[key]
-
-        # wrap the old children in a lambda to prevent excess copying, then add to children
-        def appendChild(newEdge, oldEdge, newChild, status):
-            if self.debug:
-                if len(newEdge) == 4:
-                    if newChild and len(newChild) == 4:
-                        print "Appending child to ", (newEdge[0], newEdge[1], newEdge[2].RHS, newEdge[3]), ":", (newChild[0], newChild[1], newChild[2].RHS, newChild[3])
-                    else:
-                        print "Appending child to ", (newEdge[0], newEdge[1], newEdge[2].RHS, newEdge[3]), ":", newChild
-                else:
-                    print "Appending child to ", newEdge, ":", newChild
-            childrenOfEdges[(newEdge, status)] = (newChild, oldEdge)
-
-        def getChildren(e, status=complete):
-            children = []
-            moreChildren = childrenOfEdges.get((e, status))
-            while moreChildren:
-                if moreChildren[0]:
-                    children.insert(0, moreChildren[0])
-                moreChildren = childrenOfEdges.get((moreChildren[1], inProgress))
+        # return the array of in-progress edges (i,dst,N -> alpha . sym beta)
+        def edgesWaitingFor(dst,sym):
+            return chart[dst].waiting.get(sym, ())
+
+        # return (src,dst,LHS,RHS,pos) of edge e of set dst, for debugging output
+        def showEdge(e,dst):
+            src, item = divmod(e, NI)
+            P = itemProd[item]
+            return (src, dst, P.LHS, P.RHS, item - firstItem[P])
+
+        def backPointer(e,dst):
+            bp = chart[dst].edges.get(e)
+            if bp is None:
+                bp = dropped[(dst,e)]
+            return bp
+
+        # return the right child of the packed node bp of set dst: a complete
+        # edge as (src,dst,item), or a token as (kind,lexeme)
+        def childOf(bp, dst):
+            mid, child = divmod(bp, NI)
+            return (mid, dst, child) if child else inp[mid]
+
+        def packedNodes(e, dst, bp):
+            """Yield (bp,dst) for the packed nodes along edge e of set dst,
+            from its last child back to its first; bp is the back pointer of e.
+            """
+            while bp >= 0:
+                yield bp, dst
+                e, dst = e - 1, bp // NI
+                bp = chart[dst].edges[e]
+
+        def getChildren(e, dst):
+            """Return the children of edge e of set dst: complete edges as
+            (src,dst,item) and tokens as (kind,lexeme).
+            """
+            children = [childOf(bp, d) for bp, d in packedNodes(e, dst, backPointer(e, dst))]
+            children.reverse()
             return children
 
-        def addEdge(e, oldEdge=None, childEdge=None):
-            """Add edge to graph and worklist if not present in graph already.
+        def firstChild(e, dst, bp):
+            for bp, dst in packedNodes(e, dst, bp):
+                pass
+            return childOf(bp, dst)
+
+        # return the key %left compares for complete edge e of set j,
+        # remembering it for as long as e stays in the set
+        def leftmostKey(e):
+            S = chart[j]
+            key = S.leftmost.get(e)
+            if key is None:
+                key = S.leftmost[e] = firstChild(e, j, S.edges[e])[1]
+            return key
+
+        def addEdge(e, bp=-1):
+            """Add edge e with back pointer bp to set j and to the worklist if
+            not present in the set already.
             Return True iff the edge was actually inserted
             """
-            # edge to key
-            src, dst, P, pos = e
-            status = complete if len(P.RHS) == pos else inProgress
-            (edgeList,edgeSet) = edgesIncomingTo(dst,status)
+            self.edgesTried += 1
+            S = chart[j]
+            src, item = divmod(e, NI)
+            sym = itemSym[item]
             toRemove = None
-            changed = True
-            if status == complete:      # if this is a completed edge..
-                for edge in edgeSet:    # with the same src/dst, and that hasn't been removed before
-                    if edge[0] == src and edge[2].LHS == P.LHS:
+            if sym is None:             # if this is a completed edge..
+                node = src*NR + itemRule[item]
+                edge = S.symbols.get(node)
+                if edge is not None:    # with the same src/LHS, and that hasn't been removed before
+                    (choice, ambiguous, resolved) = disambiguate(e, bp, edge)
 
-                        (choice, ambiguous, resolved) = disambiguate(e, edge, oldEdge, childEdge)
+                    self.ambiguous = self.ambiguous or ambiguous
+                    self.resolved = self.resolved and resolved
 
-                        self.ambiguous = self.ambiguous or ambiguous
-                        self.resolved = self.resolved and resolved
+                    if choice == OLD:     # keep the old edge
+                        e = edge
+                    else:               # use the new edge
+                        toRemove = edge
 
-                        if choice == OLD:     # keep the old edge
-                            e = edge
-                            changed = False
-                        else:               # use the new edge
-                            toRemove = edge
-
-                        if self.debug:
-                            print " Resolved." if resolved else " Unresolved!!!", "picked", "new" if choice == 1 else "old", "edge.", "(AMBIGUOUS)" if ambiguous else ""
+                    if self.debug:
+                        print " Resolved." if resolved else " Unresolved!!!", "picked", "new" if choice == 1 else "old", "edge.", "(AMBIGUOUS)" if ambiguous else ""
 
-            if toRemove:
+            if toRemove is not None:
+                if self.debug:
+                    print "Removing edge:", showEdge(toRemove, j)
+                S.complete.remove(toRemove)
+                S.leftmost.pop(toRemove, None)
+                dropped[(j,toRemove)] = S.edges.pop(toRemove)
+            if e not in S.edges:
                 if self.debug:
-                    print "Removing edge:", (toRemove[0], toRemove[1], toRemove[2].LHS, toRemove[2].RHS, toRemove[3])
-                edgeList.remove(toRemove)
-                edgeSet.remove(toRemove)
-            if e not in edgeSet:
-                edgeList.append(e)
-                edgeSet.add(e)
-                if changed:
-                    appendChild(e, oldEdge, childEdge, status)
+                    print "Adding edge:", showEdge(e, j), "back pointer:", divmod(bp, NI)
+                S.edges[e] = bp
+                if sym is None:
+                    S.complete.append(e)
+                    S.symbols[node] = e
+                else:
+                    S.inProgress.append(e)
+                    waiting = S.waiting.get(sym)
+                    if waiting is None:
+                        waiting = S.waiting[sym] = array('l')
+                    waiting.append(e)
+                agenda.append(e)
+                self.edgesAdded += 1
                 return True
             return False
 
+        def nullEdge(M, j):
+            """Return the item of the complete edge (j,j,M -> gamma .) deriving
+            the empty string, adding the edges of M's null derivation if need be.
+            """
+            if M not in nullEdges:
+                P = self.nullProductions[M]
+                e = j*NI + firstItem[P]
+                addEdge(e)
+                for sym in P.RHS:
+                    addEdge(e+1, j*NI + nullEdge(sym, j))
+                    e = e+1
+                # disambiguation may have kept another derivation of M
+                nullEdges[M] = chart[j].symbols[j*NR + ruleNumbers[M]] % NI
+            return nullEdges[M]
+
+        def completeEdge(e):
+            """COMPLETE the edge e = (i,j,N -> alpha .):
+            for each edge (k,i,M -> beta . N gamma)
+                add edge (k,j,M -> beta N . gamma)
+            Return True iff an edge was inserted.
+            """
+            i, item = divmod(e, NI)
+            inserted = False
+            for edge in edgesWaitingFor(i,itemLHS[item]):
+                inserted = addEdge(edge+1, e) or inserted
+            return inserted
+
+        def advance(j):
+            """ADVANCE across the token inp[j-1]:
+            for each edge (i,j-1,N -> alpha . inp[j-1] beta)
+                add edge (i,j,N -> alpha inp[j-1] . beta)
+            """
+            for e in edgesWaitingFor(j-1,inp[j-1][0]):
+                addEdge(e+1, (j-1)*NI)
+
+        def predictEdge(e):
+            """PREDICT what the parser is to see on input after e = (i,j,N -> alpha . M beta):
+            for each production D -> gamma, D in the prediction closure of M,
+                    that can start with the next token inp[j] or derive nothing
+                add edge (j,j,D -> . gamma)
+            and if M is nullable, step over it right away (Aycock & Horspool)
+                add edge (i,j,N -> alpha M . beta)
+            Return True iff an edge was inserted.
+            """
+            M = itemSym[e % NI]
+            inserted = False
+            if not (self.predictionTables or self.engine == 'worklist'):
+                if M[0] != EarleyParser.TERM_PFX:  # terminals start with a special char
+                    # prediction: for all rules D->alpha add edge (j,j,.alpha)
+                    for D in self.grammar[M].productions:
+                        inserted = addEdge(j*NI + firstItem[D]) or inserted
+            elif M in self.predictItems:
+                if M not in predicted:
+                    # the closure of M holds that of every nonterminal in it
+                    predicted.update(self.predictSymbols[M])
+                    items = self.predictItems[M]
+                    if self.lookahead and j < len(inp):
+                        # only what can start with the next token, which
+                        # is not known yet at the end of the input
+                        byToken, null = self.predictLookahead[M]
+                        items = byToken.get(inp[j][0], null)
+                        self.predictionsAvoided += len(self.predictItems[M]) - len(items)
+                    elif self.lookahead and deferred is not None:
+                        # ... or not lexed yet; see lexToken
+                        deferred.append(M)
+                        items = ()
+                    for item in items:
+                        inserted = addEdge(j*NI + item) or inserted
+                if M in self.nullable:
+                    inserted = addEdge(e+1, j*NI + nullEdge(M, j)) or inserted
+            return inserted
+
+        def predictDeferred(Ms):
+            """PREDICT the closures of the nonterminals Ms, left by predictEdge
+            until the token at j was lexed, as predictEdge would have.
+            """
+            for M in Ms:
+                items = self.predictItems[M]
+                if j < len(inp):
+                    byToken, null = self.predictLookahead[M]
+                    items = byToken.get(inp[j][0], null)
+                    self.predictionsAvoided += len(self.predictItems[M]) - len(items)
+                for item in items:
+                    addEdge(j*NI + item)
+
+        # lex the token at j, after set j, if there is still text to lex
+        def lexNext(j):
+            try:
+                self.lexToken(chart[j], deferred, inp, source)
+            except NameError:
+                self.parsedepth = self.parsedepth - 1
+                if stats:
+                    pause(True)
+                raise
+
+        def work(edges):
+            """COMPLETE or PREDICT each of the edges of set j, in order."""
+            S = chart[j]
+            for e in edges:
+                if itemSym[e % NI] is not None:
+                    predictEdge(e)
+                elif e in S.edges:      # unless disambiguation dropped it
+                    completeEdge(e)
+
         # return (edge, ambiguous?, resolved?), where edge is either e1 or e2, others are boolean
-        def disambiguate(e1, e2, oldE1, childE1):
+        def disambiguate(e1, bp1, e2):
 
             # parse out any information about operators, etc.
-            opPrec1,assoc1,dprec1,subsym1,op1 = e1[2].info
-            opPrec2,assoc2,dprec2,subsym2,op2 = e2[2].info
-            childrenE1 = getChildren(oldE1, inProgress)
-            if childE1:
-                childrenE1.append(childE1)
-            childrenE2 = getChildren(e2)
+            opPrec1,assoc1,dprec1,subsym1,op1 = itemProd[e1 % NI].info
+            opPrec2,assoc2,dprec2,subsym2,op2 = itemProd[e2 % NI].info
+            bp2 = backPointer(e2, j)
 
             if self.debug:
-                print "Ambiguity: ", e1[2].LHS, "->", e1[2].RHS, ", ", e2[2].LHS, "->", e2[2].RHS
-                print " from ", e2[0], " to ", e2[1]
-                print " ", inp[e2[0]:e2[1]]
+                def show(c):
+                    return showEdge(c[0]*NI + c[2], c[1]) if len(c) == 3 else c
+                childrenE1 = [childOf(*n) for n in packedNodes(e1, j, bp1)][::-1]
+                childrenE2 = [childOf(*n) for n in packedNodes(e2, j, bp2)][::-1]
+                print "Ambiguity: ", op1.LHS, "->", op1.RHS, ", ", op2.LHS, "->", op2.RHS
+                print " from ", e2 // NI, " to ", j
+                print " ", inp[e2 // NI:j]
                 print " (opPrec2, assoc2, dprec2, op2) = ", opPrec2,assoc2,dprec2,op2.RHS
-                print "   children of old:", [(c[0], c[1], c[2].RHS, c[3]) if len(c) == 4 else c for c in childrenE2]
+                print "   children of old:", [show(c) for c in childrenE2]
                 print " (opPrec1, assoc1, dprec1, op1) = ", opPrec1,assoc1,dprec1,op1.RHS
-                print "   children of new:", [(c[0], c[1], c[2].RHS, c[3]) if len(c) == 4 else c for c in childrenE1]
+                print "   children of new:", [show(c) for c in childrenE1]
+
+            if e1 % NI == e2 % NI:
+                # an in-progress edge has a single packed node, so the same
+                # production has the same children iff its back pointers match
+                same = bp1 == bp2
+            elif op1.RHS != op2.RHS:
+                same = False    # a child always derives the symbol it stands for
+            else:
+                same = [childOf(*n) for n in packedNodes(e1, j, bp1)] == \
+                       [childOf(*n) for n in packedNodes(e2, j, bp2)]
 
-            if childrenE1 == childrenE2:
+            if same:
                 return (OLD, False, True)    # same children => same edge. no ambiguity here, doc
             elif opPrec1 != None and opPrec2 != None:
                 if opPrec1 == opPrec2:              # time for the associativity check OF DOOM
                     if assoc1[0] == 'left' and assoc2[0] == 'left':     # think (l + m + n)
                         # the one with the longer left side
-                        if childrenE1[0][1] > childrenE2[0][1]:
+                        left1 = firstChild(e1, j, bp1)[1]
+                        left2 = leftmostKey(e2)
+                        if left1 > left2:
                             return (NEW, False, True)
-                        elif childrenE1[0][1] < childrenE2[0][1]:
+                        elif left1 < left2:
                             return (OLD, False, True)
                         else:
                             return (NEW, True, False)    # the stupid case in which two production cover the *same string*
                     elif assoc1[0] == 'right' and assoc2[0] == 'right': # think (y = x = 1)
                         # the one with the longer right side
-                        if childrenE1[-1][0] < childrenE2[-1][0]:
+                        right1 = childOf(bp1, j)[0]
+                        right2 = childOf(bp2, j)[0]
+                        if right1 < right2:
                             return (NEW, False, True)
-                        elif childrenE1[-1][0] > childrenE2[-1][0]:
+                        elif right1 > right2:
                             return (OLD, False, True)
                         else:
                             return (NEW, True, False)    # the stupid case in which two production cover the *same string*
@@ -216,10 +868,11 @@ class EarleyParser:
             else:
                 return (OLD, True, False)        # FAILURE TO DISAMBIGUATE
 
+        # e is a complete edge (src,dst,item)
         def makeTree(e,i=1):
             n = i
-            children = [x for x in getChildren(e) if x]
-            lhs = e[2].LHS.replace('"','\\"')
+            children = [x for x in getChildren(e[0]*NI + e[2], e[1]) if x]
+            lhs = itemLHS[e[2]].replace('"','\\"')
             gviz.write(str(n)+ '[label = "%s"];\n' % (lhs)) #add a node for the current
             if len(children) == 1 and len(children[0])==2: #a terminal
                 gviz.write(str(n)+' [label = "%s"];\n' % (lhs))
@@ -234,9 +887,10 @@ class EarleyParser:
                 return i+1
             op = 0
             for child in children:
-                if len(child) == 4:
-                    gviz.write(str(i+1) + '[label = "%s"];\n' % child[2].LHS.replace('"','\\"'))
-                    gviz.write('    %s -> %s [label = "%s",width=2];\n' % (str(n), str(i+1), lhs+'->'+child[2].LHS.replace('"','\\"')))
+                if len(child) == 3:
+                    childLHS = itemLHS[child[2]].replace('"','\\"')
+                    gviz.write(str(i+1) + '[label = "%s"];\n' % childLHS)
+                    gviz.write('    %s -> %s [label = "%s",width=2];\n' % (str(n), str(i+1), lhs+'->'+childLHS))
                     i = makeTree(child,i+1)
 
                 elif len(child) == 2:
@@ -247,22 +901,44 @@ class EarleyParser:
             return i+1
 
         def doSDT(edge):
-            children = [x for x in getChildren(edge) if x]
-            if len(children) == 1 and len(children[0])==2: #terminal
-                term = children[0]
-                return [saObject(None,[],term[1])]
-
-            elif len(children) == 0:#epsilon
-                return [saObject(None,[],None)]
-
-            else:
-                toReturn = []
-                for child in children:
-                    if len(child) == 4: #nonterm
-                        toReturn.append(saObject(child[2].actions[-1], doSDT(child)))
-                    elif len(child) == 2: #operator
-                        toReturn.append(saObject(None,None,child[1]))
-                return toReturn
+            """Return the value of the complete edge (src,dst,item): the
+            S-action of its production applied to the values of its children,
+            where a token's value is its lexeme and an epsilon production gets
+            a single None.  Walks the tree with an explicit stack of
+            [edge, children, next child, values] frames, so deeply nested
+            input is not limited by Python's recursion depth.
+            """
+            stack = [[edge, getChildren(edge[0]*NI + edge[2], edge[1]), 0, []]]
+            while True:
+                frame = stack[-1]
+                edge, children, i, values = frame
+                if i < len(children):
+                    frame[2] = i + 1
+                    child = children[i]
+                    if len(child) == 3: #nonterm
+                        stack.append([child, getChildren(child[0]*NI + child[2], child[1]), 0, []])
+                    else:               #terminal
+                        values.append(child[1])
+                    continue
+                stack.pop()
+                v = itemProd[edge[2]].actions[-1](None, *(values or [None]))
+                if not stack:
+                    return v
+                stack[-1][3].append(v)
+
+        # statistics, when asked for (see ParseStats)
+        stats = None
+        if self.collectStats:
+            stats = self.stats = ParseStats()
+            advance = stats.timed(self, advance, 'scan')
+            predictEdge = stats.timed(self, predictEdge, 'predict')
+            predictDeferred = stats.timed(self, predictDeferred, 'predict')
+            completeEdge = stats.timed(self, completeEdge, 'complete')
+            doSDT = stats.timed(self, doSDT, 'sdt')
+            disambiguate = stats.counted(disambiguate, NEW)
+
+        def pause(final):
+            stats.pause(self, inp, chart, dropped, final)
 
         ######################
         ### FUNCTION START ###
@@ -284,134 +960,325 @@ class EarleyParser:
         self.parsedepth = 0
         line = (yield "Prepped for parse-off, cap'n!")
         inp = line
+        source = [None, 0]          # text still to lex, if sent text rather than tokens, and where
+        if isinstance(line, basestring):
+            inp, source[0] = [], line
         self.parsedepth += 1
-
-        # Add edge (0,0,(S -> . alpha)) to worklist, for all S -> alpha
-        for P in self.grammar[self.grammar.startSymbol].productions:
-            addEdge((0,0,P,0))
+        self.edgesTried = self.edgesAdded = self.passes = self.predictionsAvoided = 0
+        if stats:
+            stats.resume()
 
         # for all tokens on the input:
         j = 0
+        chart.append(EarleySet())
+        settled = 0                 # sets before this one have in-progress edges, and are pruned
+        live = set()                # sets whose waiting edges the last pruning kept
+        pruneAt = self.pruneEvery   # prune once this many edges have been added
+
+        # Add edge (0,0,(S -> . alpha)) to worklist, for all S -> alpha
+        for P in self.grammar[self.grammar.startSymbol].productions:
+            addEdge(firstItem[P])
+        if stats:
+            stats.items['predict'] += self.edgesAdded
 
         # keep going until we get a full completion edge
         done = False
         while not done:
             while j <= len(inp):
+                predicted = set()       # nonterminals predicted at j
+                nullEdges = {}          # nullable nonterminal -> item of its null edge at j
+                if len(chart) == j:
+                    chart.append(EarleySet())
+                S = chart[j]
+
+                # Lexing on demand, the token at j is only lexed once set j
+                # tells what it may be, so the worklist leaves predicting
+                # until then (see predictEdge and lexToken)
+                lexing = source[0] is not None and j == len(inp)
+                deferred = [] if lexing and self.engine == 'worklist' else None
 
                 # skip in first iteration; we need to complete and predict the
                 # start nonterminal S before we start advancing over the input
                 if j > 0:
-                    # ADVANCE across the next token:
-                    # for each edge (i,j-1,N -> alpha . inp[j] beta)
-                    #     add edge (i,j,N -> alpha inp[j] . beta)
                     if self.debug:
                         print "*ADVANCE*"
-                    for (i,_j,P,pos) in edgesIncomingTo(j-1,inProgress)[0]:
-                        assert _j==j-1
-                        if pos < len(P.RHS) and P.RHS[pos]==inp[j-1][0]:
-                            addEdge((i,j,P,pos+1), (i,_j,P,pos), inp[_j])
-
-                # Repeat COMPLETE and PREDICT until no more edges can be added
-                edgeWasInserted = True
-                while edgeWasInserted:
-                    edgeWasInserted = False
-                    # COMPLETE productions
-                    # for each edge (i,j,N -> alpha .)
-                    #    for each edge (k,i,M -> beta . N gamma)
-                    #        add edge (k,j,M -> beta N . gamma)
-                    if self.debug:
-                        print "*COMPLETE*"
-                    for (i,_j,P,pos) in edgesIncomingTo(j,complete)[0]:
-                        assert _j==j and pos == len(P.RHS)
-                        for (k,_i,Q,pos2) in edgesIncomingTo(i,inProgress)[0]:
-                            assert _i==i and pos2 < len(Q.RHS)
-                            if Q.RHS[pos2]==P.LHS:
-                                edgeInsertedNow = addEdge((k,j,Q,pos2+1), (k,i,Q,pos2), (i,j,P,pos))
-                                edgeWasInserted = edgeInsertedNow or edgeWasInserted
-
-                    # PREDICT what the parser is to see on input (move dots in edges that are in progress)
-                    # for each edge (i,j,N -> alpha . M beta)
-                    #     for each production M -> gamma
-                    #          add edge (j,j,M -> . gamma)
+                    advance(j)
+
+                if self.engine == 'worklist':
+                    # COMPLETE or PREDICT each edge of set j exactly once, in
+                    # the order the edges were added (the agenda grows as we go)
                     if self.debug:
-                        print "*PREDICT*"
-                    for (i,_j,P,pos) in edgesIncomingTo(j,inProgress)[0]:
-                        assert _j==j and pos < len(P.RHS)
-                        if P.RHS[pos][0] not in ('*','@'):  # non-terminals start with special chars
-                            M = P.RHS[pos]
-                            # prediction: for all rules D->alpha add edge (j,j,.alpha)
-                            for P in self.grammar[M].productions:
-                                edgeInsertedNow = addEdge((j,j,P,0))
-                                edgeWasInserted = edgeInsertedNow or edgeWasInserted
+                        print "*COMPLETE/PREDICT*"
+                    self.passes += 1
+                    work(agenda)
+
+                else:
+                    # Repeat COMPLETE and PREDICT until no more edges can be added
+                    edgeWasInserted = True
+                    while edgeWasInserted:
+                        edgeWasInserted = False
+                        self.passes += 1
+                        if self.debug:
+                            print "*COMPLETE*"
+                        for e in S.complete:
+                            edgeWasInserted = completeEdge(e) or edgeWasInserted
+                        if self.debug:
+                            print "*PREDICT*"
+                        for e in S.inProgress:
+                            edgeWasInserted = predictEdge(e) or edgeWasInserted
+
+                if lexing:
+                    lexNext(j)
+                    if deferred:
+                        start = len(agenda)
+                        predictDeferred(deferred)
+                        deferred = None
+                        work(islice(agenda, start, None))
+
+                # every so often, drop what the parse is done with
+                if pruneAt is not None and self.edgesAdded >= pruneAt and S.inProgress:
+                    if stats:
+                        stats.chartBytes = max(stats.chartBytes, ParseStats.sizeOf(chart, dropped))
+                    live = self.pruneChart(chart, dropped, j, settled, live)
+                    pruneAt = self.edgesAdded + self.pruneEvery
+                    settled = j
+                    if stats:
+                        stats.pruned += 1
 
                 # remember to advance in the input
+                del agenda[:]
                 j = j + 1
 
             # input has been parsed OK if and only if an edge (0,n,S -> alpha .) exists
             for P in self.grammar[self.grammar.startSymbol].productions:
-                if (0,len(inp),P,len(P.RHS)) in edgesIncomingTo(len(inp),complete)[1]:
+                item = firstItem[P] + len(P.RHS)
+                if item in chart[len(inp)].edges:   # the edge 0*NI+item
 
                     if self.drawGraph:
-                        makeTree((0,len(inp),P,len(P.RHS)))
+                        makeTree((0,len(inp),item))
                         gviz.write('}')
                         gviz.close()
 
-                    SDTree = saObject( P.actions[-1], doSDT( (0, len(inp), P, len(P.RHS))) )
                     try:
-                        v = SDTree.act().val
+                        v = doSDT((0, len(inp), item))
                     except Exception, e:
                         if self.debug:
                             print e.message
                         util.error("My code is a snake, your Python is invalid.")
                     self.parsedepth = self.parsedepth - 1
                     done = True         # no need to continue iterating
+                    if stats:
+                        pause(True)
                     yield v             # return the AST of this line, then quit
 
             # if we're not done yet, check to see if we can still continue
-            if len(edgesIncomingTo(len(inp), inProgress)[0]) > 0:
+            if len(chart[len(inp)].inProgress) > 0:
+                if stats:
+                    pause(False)
                 line = (yield None)                 # if we can, wait for more input
-                inp = inp + line                    # and stick it on the end
+                if stats:
+                    stats.resume()
+                if isinstance(line, basestring):    # lex it as we go
+                    inp, source[:], deferred = list(inp), [line, 0], None
+                    lexNext(len(inp))
+                else:
+                    inp = inp + line                # and stick it on the end
             else:                                   # if there's no chance of going on, we're stuck.
                 self.parsedepth = self.parsedepth - 1
-                for i in xrange(0,len(inp)+1):      # so search for the error position and report it.
-                    if len(edgesIncomingTo(i, inProgress)[0]) == 0:
+                if stats:
+                    pause(True)
+                for i in xrange(settled,len(inp)+1):  # so search for the error position and report it.
+                    if len(chart[i].inProgress) == 0:
                         raise SyntaxError('Bad syntax at token %d: %s' % (i-1,inp[i-1][1]))
                 raise SyntaxError('Bad syntax at token %d: %s' % (j,inp[j][1]))
 
-    def tokenize (self, inp):
-        '''Return the tokenized version of INP, a sequence of
-        (token, lexeme) pairs.
+    def pruneChart (self, chart, dropped, j, since, wasLive):
+        '''Drop what the rest of the parse can no longer reach from the
+        sets SINCE..J-1 of CHART, those built since the last pruning: the
+        edges waiting in sets that no edge can complete back into any
+        more, and the back pointers that none of the edges still waiting,
+        nor those of set J, lead to.  Sets before SINCE were pruned already
+        and are kept as they are, but for the edges waiting in the ones of
+        WASLIVE, the sets live then, that are no longer.  What is left is
+        the live frontier and the parse forest under it.  DROPPED, the back
+        pointers of the edges disambiguation removed, is pruned in place.
+        Returns the sets live now.
         '''
-        tokens = []
-        pos = 0
-
+        # The edges waiting in set s for the symbol A can only ever be
+        # advanced by an edge (s,j,A -> alpha . beta) of set j completing,
+        # or by one those edges lead to in turn when they complete.
+        NI, itemLHS, PRUNED = len(self.itemProd), self.itemLHS, EarleyParser.PRUNED
+        live = defaultdict(set)     # set -> symbols whose waiting edges are kept
+        stack = list(chart[j].inProgress)
+        while stack:
+            src, item = divmod(stack.pop(), NI)
+            if src != j and itemLHS[item] not in live[src]:
+                live[src].add(itemLHS[item])
+                stack.extend(chart[src].waiting.get(itemLHS[item], ()))
+        for i in wasLive.union(live):
+            S = chart[i]
+            S.waiting = dict([(sym, S.waiting[sym]) for sym in live.get(i, ())
+                              if sym in S.waiting])
+
+        # and everything their edges point to.  A back pointer leads
+        # to a child in the same set, and a left sibling in the same
+        # set or an earlier one, so the sets are done from j down.
+        kept = {}                   # set -> { edge : back pointer }
+        keptDropped = dict([(key, bp) for key, bp in dropped.iteritems() if key[0] < since])
+        pending = defaultdict(list) # set -> edges to keep there
+        for i in live:
+            if i >= since:
+                for edges in chart[i].waiting.itervalues():
+                    pending[i].extend(edges)
+        pending[j].extend(chart[j].edges)
+        for dst in xrange(j, since - 1, -1):
+            stack = pending.pop(dst, None)
+            if stack is None:
+                continue
+            edges = chart[dst].edges
+            keep = kept[dst] = {}
+            while stack:
+                e = stack.pop()
+                if e in keep:
+                    continue
+                bp = edges.get(e)
+                if bp is None:
+                    if (dst, e) in keptDropped:
+                        continue
+                    bp = keptDropped[(dst, e)] = dropped[(dst, e)]
+                else:
+                    keep[e] = bp
+                if bp >= 0:
+                    mid = bp // NI
+                    if mid == dst:
+                        stack.append(e - 1)
+                    else:
+                        pending[mid].append(e - 1)
+                    if bp != mid*NI:
+                        stack.append(bp)
+
+        for i in xrange(since, j):
+            keep = kept.get(i)
+            if not keep and i not in live:
+                chart[i] = PRUNED
+                continue
+            S = chart[i]
+            S.edges = keep or {}
+            if i not in live:
+                S.waiting = PRUNED.waiting
+            # only ever used while the set is being built
+            S.complete, S.symbols, S.leftmost, S.inProgress = \
+                PRUNED.complete, PRUNED.symbols, PRUNED.leftmost, PRUNED.inProgress
+        dropped.clear()
+        dropped.update(keptDropped)
+        return set(live)
+
+    def lexToken (self, S, deferred, inp, source):
+        '''Lex the token after S, the last set of the chart, off SOURCE,
+        the text being lexed on demand and the position reached in it, and
+        append it to INP; stop lexing once the text is used up or the parse
+        has failed.  The token is the longest match, as the batch tokenizer
+        has it, so keywords stay reserved.  If it is not one that S waits
+        for or the predictions DEFERRED there can start with, lexing stops
+        there: the parse fails on it.  Raises NameError if the text cannot
+        be lexed.
+        '''
+        text, pos = source
+        if not S.edges:
+            source[0] = None
+            return
+        key = (frozenset(S.waiting), tuple(deferred or ()))
+        expected = self.expectedTokens.get(key)
+        if expected is None:
+            expected = set([sym for sym in S.waiting if sym[0] == EarleyParser.TERM_PFX])
+            for M in deferred or ():
+                expected |= self.predictTokens[M]
+            expected = self.expectedTokens[key] = frozenset(expected)
         while True:
-            matchLHS = 0
-            matchText = None
-            matchEnd = -1
-
-            for regex, lhs in self.terminals:
-                match = regex.match (inp, pos)
-                if match and match.end () > matchEnd:
-                    matchLHS = lhs
-                    matchText = match.group ()
-                    matchEnd = match.end ()
-
-            if pos == len (inp):
-                if matchLHS:  tokens.append ((matchLHS, matchText))
-                break
-            elif pos == matchEnd:       # 0-length match
+            kind, end = self.lexer.scan(text, pos)
+            if pos == len(text):
+                source[0] = None
+                if kind:
+                    inp.append((kind, text[pos:end]))
+                return
+            elif pos == end:        # 0-length match
                 raise NameError, pos
-            elif matchLHS is None:      # 'Ignore' tokens
-                pass
-            elif matchLHS:              # Valid token
-                tokens.append ((matchLHS, matchText))
-            else:                       # no match
-                raise NameError, str(pos) + ": " + str(inp[max(pos-5,0):min(pos+5,len(inp))])
+            elif kind:              # Valid token
+                inp.append((kind, text[pos:end]))
+                source[1] = end
+                if kind not in expected:
+                    source[0] = None    # a syntax error; nothing after it matters
+                return
+            elif kind is not None:  # no match
+                raise NameError, str(pos) + ": " + str(text[max(pos-5,0):min(pos+5,len(text))])
+            pos = end               # 'Ignore' tokens
+
+    def recognize (self, inp):
+        '''Return True if INP is a complete statement, None if it is not
+        yet, but can go on to be one, and False if it is a syntax error.
+        INP is a sequence of (token, lexeme) pairs or the text to lex.
+
+        Only the recognizer's part of parse is done: each Earley set is
+        just the edges waiting on each symbol, with no back pointers to
+        keep, no disambiguation and no semantic actions.  Nullable
+        nonterminals are stepped over as they are predicted (Aycock &
+        Horspool), so completing an edge never has to look at its own set.
+        '''
+        if isinstance (inp, basestring):
+            try:
+                inp = self.tokenize (inp)
+            except NameError:
+                return False
+
+        NI = len (self.itemProd)
+        itemSym, itemLHS = self.itemSym, self.itemLHS
+        nullable, predictItems, predictSymbols = \
+            self.nullable, self.predictItems, self.predictSymbols
+        chart = []                      # per set: { symbol : [ edges waiting for it ] }
+        agenda = [self.firstItem[P] for P in self.grammar[self.grammar.startSymbol].productions]
+
+        for j in xrange (len (inp) + 1):
+            waiting = {}
+            chart.append (waiting)
+            seen = set (agenda)
+            predicted = set ()
+            for e in agenda:
+                src, item = divmod (e, NI)
+                sym = itemSym[item]
+                if sym is None:         # COMPLETE
+                    if src == j:  continue
+                    new = [edge + 1 for edge in chart[src].get (itemLHS[item], ())]
+                else:
+                    waiting.setdefault (sym, []).append (e)
+                    new = [e + 1] if sym in nullable else []
+                    if sym in predictItems and sym not in predicted:    # PREDICT
+                        predicted.update (predictSymbols[sym])
+                        items = predictItems[sym]
+                        if self.lookahead and j < len (inp):
+                            byToken, null = self.predictLookahead[sym]
+                            items = byToken.get (inp[j][0], null)
+                        new.extend ([j*NI + i for i in items])
+                for edge in new:
+                    if edge not in seen:
+                        seen.add (edge)
+                        agenda.append (edge)
+
+            if j == len (inp):
+                break
+            agenda = [e + 1 for e in waiting.get (inp[j][0], ())]  # SCAN
+            if not agenda:
+                return False
 
-            pos = matchEnd
+        for P in self.grammar[self.grammar.startSymbol].productions:
+            if self.firstItem[P] + len (P.RHS) in seen:
+                return True
+        return None if waiting else False
 
-        return tokens
+    def tokenize (self, inp):
+        '''Return the tokenized version of INP, a sequence of
+        (token, lexeme) pairs.
+        '''
+        return self.lexer.tokenize (inp)
 
 
     def dump (self, f=sys.stdout):
@@ -424,17 +1291,65 @@ class EarleyParser:
 
     ##---  STATIC  ------------------------------------------------------------
 
+    @staticmethod
+    def compile (gram, reduce=True, climb=True):
+        '''Returns the tuple:
+
+        (
+          GRAM,
+          [ (regex, lhs) ],             # see preprocess
+          { renamed terminal : pattern },
+          Lexer of the terminals,
+          (nullable, nullProductions, predictions, starts),     # see analyze
+          (itemProd, itemSym, itemLHS, firstItem),      # see numberItems
+          marshalled code object defining every semantic function,
+          [ description of a change made by reduce ],
+        )
+
+        which is everything EarleyParser needs from GRAM, and can be
+        pickled.  The semantic functions are bound by bindSemantFuncs.
+        Unless REDUCE is False, the preprocessed grammar is simplified by
+        EarleyParser.reduce, and unless CLIMB is False, its operator
+        expressions are parsed by precedence climbing (see operatorRules).
+
+        WARNING: modifies GRAM argument.
+        '''
+        terminals, invRenamedTerminals, sources = EarleyParser.preprocess (gram, climb)
+        reductions = []
+        if reduce:
+            reductions = EarleyParser.reduce (gram, sources)
+        try:
+            code = compile ('\n'.join (sources), '<semantic actions>', 'exec')
+        except Exception, e:
+            for source in sources:      # find the culprit
+                try:
+                    compile (source, '<semantic action>', 'exec')
+                except Exception, e:
+                    break
+            util.error ("""couldn't create semantic function: """ + str(e))
+            sys.exit(1)
+        return (gram, terminals, invRenamedTerminals, Lexer (terminals),
+                EarleyParser.analyze (gram), EarleyParser.numberItems (gram),
+                marshal.dumps (code), reductions)
+
     TERM_PFX = '*'     # prefix of nonterminals replacing terminals
-    NONTERM_PFX = '@'  # prefix of nonterminals replacing RHSs with > 2 symbols
+    NONTERM_PFX = '@'  # prefix of nonterminals made up by the parser generator
 
     @staticmethod
-    def preprocess (gram):
+    def preprocess (gram, climb=True):
         '''Returns the tuple:
 
         (
           [ (regex, lhs) ],             # pattern/token list
+          { renamed terminal : pattern },
+          [ source of a semantic function ],
         )
 
+        The actions of GRAM's productions are replaced by (name, direct)
+        pairs naming functions defined in the sources; see makeSemantFunc.
+        Unless CLIMB is False, operator rules are rewritten by
+        operatorRules.
+
         WARNING: modifies GRAM argument.
         '''
 
@@ -443,13 +1358,7 @@ class EarleyParser:
         terminals = []
         renamedTerminals = {}
         epsilons = []
-
-        # Import all the grammar's modules into a new global object
-        try:
-            glob = util.doImports (gram.imports)
-        except Exception, e:
-            util.error ('problem importing %s: %s' % (gram.imports, str(e)))
-            sys.exit(1)
+        sources = []
 
         # Add 'ignore' patterns to the terminals list
         for regex in gram.ignores:
@@ -476,10 +1385,10 @@ class EarleyParser:
                 # Create the S-action, if specified
                 if actions[len (rhs)]:
                     actions[len (rhs)] = EarleyParser.makeSemantFunc (
-                        actions[len (rhs)], len (rhs), glob)
+                        actions[len (rhs)], len (rhs), sources)
                 else:
                     actions[len (rhs)] = EarleyParser.makeSemantFunc (
-                        "return n1.val", len (rhs), glob)
+                        "return n1.val", len (rhs), sources)
                 # Pull out epsilons and terminals
                 for i, sym in enumerate (rhs):
                     if sym == grammar.Grammar.EPSILON:
@@ -514,7 +1423,7 @@ class EarleyParser:
                     if actions[i]:
                         # I-action for this symbol
                         actions[i] = EarleyParser.makeSemantFunc (
-                            actions[i], len (rhs), glob)
+                            actions[i], len (rhs), sources)
 
                 production.RHS = tuple(rhs)
 
@@ -561,20 +1470,883 @@ class EarleyParser:
                 # Information about this production to be used during parsing
                 production.info = (opPrec, assoc, dprec, subsym, production)
 
-        return terminals, dict([(new,orig) for (orig,new) in renamedTerminals.iteritems()])
+        if climb:
+            for rule in list (gram.rules):
+                EarleyParser.operatorRules (gram, rule, sources)
 
+        return terminals, dict([(new,orig) for (orig,new) in renamedTerminals.iteritems()]), sources
 
     @staticmethod
-    def makeSemantFunc (code, numArgs, globalObject):
+    def operatorRules (gram, rule, sources):
+        '''Take the binary operator productions of RULE, X -> X op X with op
+        a terminal, out of the ambiguous grammar: X is split into
+
+            X           -> @X.operators
+            @X.operators -> @X.operand | @X.operators op @X.operand | ...
+            @X.operand  -> the other productions of X
+
+        so an operator expression is recognized as one flat, unambiguous
+        chain of operands, which the precedence-climbing action of
+        X -> @X.operators (see makeClimber) then builds into the tree
+        disambiguate would have picked.  The leading X of postfix
+        productions, X -> X '[' X ']' and the like, becomes @X.operand:
+        their lower %dprec already keeps them under the operators.
+
+        An operator without a %left/%right declaration, like 'in' in
+        cs164b.grm, is settled against the others by %dprec alone, which
+        keeps the edge found first.  When it has the %dprec of the declared
+        operators, the climber can still build the same tree; see
+        makeClimber.
+
+        RULE is left alone when its productions do not fit this shape, or
+        an undeclared operator has a %dprec of its own.  Call on a
+        preprocessed GRAM; SOURCES as in makeSemantFunc.
+        '''
+        X = rule.lhs
+        operators, binary, postfix, operands = [], [], [], []
+        for production in rule.productions:
+            rhs = production.RHS
+            if len (rhs) == 3 and rhs[0] == X and rhs[2] == X:
+                if rhs[1].startswith (EarleyParser.TERM_PFX) \
+                        and not [a for a in production.actions[:-1] if a]:
+                    operators.append (production)
+                else:
+                    binary.append (production)
+            elif rhs and rhs[-1] == X:
+                return          # a prefix operator, or X -> X
+            elif rhs and rhs[0] == X:
+                postfix.append (production)
+            else:
+                operands.append (production)
+        declared = [production for production in operators if production.info[0] != None]
+        if not declared or binary:
+            return
+        lowest = min ([production.info[2] for production in declared])
+        if len (declared) < len (operators) and \
+                len (set ([production.info[2] for production in operators])) > 1:
+            return
+        for production in postfix:
+            if production.info[2] == None or lowest == None or production.info[2] >= lowest:
+                return          # it could take an operator expression apart
+
+        operand = grammar.Rule ('%s%s.operand'% (EarleyParser.NONTERM_PFX, X))
+        chain = grammar.Rule ('%s%s.operators'% (EarleyParser.NONTERM_PFX, X))
+        for production in rule.productions:
+            if production in postfix:
+                production.RHS = (operand.lhs,) + production.RHS[1:]
+            if production in postfix or production in operands:
+                production.LHS = operand.lhs
+                operand.productions.append (production)
+
+        # A chain is built up as nested tuples, (operand,) and then
+        # (chain, operator number, lexeme, operand), for the climber to take
+        # apart; the operator productions themselves are no longer parsed
+        def add (lhs, rhs, code, dprec=None):
+            action = code and EarleyParser.makeSemantFunc (code, len (rhs), sources)
+            production = grammar.Production (lhs, rhs, [None] * len (rhs) + [action], -1, None, None)
+            production.info = (None, None, dprec, None, production)
+            return production
+        chain.productions.append (add (chain.lhs, (operand.lhs,), ' return (n1.val,)'))
+        for i, production in enumerate (operators):
+            chain.productions.append (add (chain.lhs, (chain.lhs, production.RHS[1], operand.lhs),
+                                           ' return (n1.val, %d, n2.val, n3.val)'% (i)))
+        top = add (X, (chain.lhs,), None, lowest)
+        top.operators = operators
+
+        rule.productions = [top]
+        gram.addRule (chain)
+        gram.addRule (operand)
+
+
+    IDENTITY = re.compile (r'def \w+\(n0,n1\):\s*return\s+n1\s*$')
+
+    @staticmethod
+    def reduce (gram, sources):
+        '''Simplify the preprocessed GRAM without changing the AST of any
+        parse.  Returns a list of lines describing the changes.
+
+        Nonterminals that derive no string of tokens, and the productions
+        using them, are removed.  A unit chain -- a nonterminal B with a
+        single production B -> C, C one symbol -- is inlined: every use of
+        B becomes C, and B's S-action is composed into the S-action of the
+        production using it (see bindSemantFuncs).  That saves the parser
+        an item and a completion for each B in the input.  Then
+        nonterminals that can't be reached from the start symbol are
+        removed.
+
+        Unit productions of nonterminals with several productions, like
+        Vn -> E, are left alone: disambiguate settles ambiguities between
+        productions of the same nonterminal, so folding E's productions
+        into Vn would change which parse wins.  A single production has
+        nothing to compete with, so inlining B changes no choice.
+        SOURCES is as from preprocess; S-actions returning n1.val are not
+        composed at all.
+        '''
+        report = []
+        identities = set ([source[4:source.index ('(')] for source in sources
+                           if EarleyParser.IDENTITY.match (source)])
+
+        # Productive nonterminals, those deriving some string of tokens
+        rules = dict ([(rule.lhs, rule) for rule in gram.rules])
+        productive = set ()
+        changed = True
+        while changed:
+            changed = False
+            for rule in gram.rules:
+                if rule.lhs in productive:  continue
+                for production in rule.productions:
+                    if not [sym for sym in production.RHS if sym in rules and sym not in productive]:
+                        productive.add (rule.lhs)
+                        changed = True
+                        break
+        for rule in list (gram.rules):
+            if rule.lhs not in productive:
+                report.append ('removed unproductive nonterminal %s'% (rule.lhs))
+                gram.rules.remove (rule)
+                continue
+            kept = [production for production in rule.productions
+                    if not [sym for sym in production.RHS if sym in rules and sym not in productive]]
+            if len (kept) < len (rule.productions):
+                report.append ('removed %d unproductive productions of %s'
+                               % (len (rule.productions) - len (kept), rule.lhs))
+                rule.productions = kept
+
+        # Unit chains.  The S-action of a production is (name, direct) or,
+        # once something is inlined into it, (name, direct, inlined), with
+        # INLINED the [(position, S-action)] to apply to the values of its
+        # children first, in order.
+        def inlinable (rule):
+            if len (rule.productions) != 1 or rule.lhs == gram.startSymbol:
+                return False
+            production = rule.productions[0]
+            return (len (production.RHS) == 1 and production.RHS[0] != rule.lhs
+                    and not production.operators and not production.subsym
+                    and not [a for a in production.actions[:-1] if a])
+        changed = True
+        while changed:
+            changed = False
+            for rule in gram.rules:
+                if not inlinable (rule):  continue
+                B = rule.lhs
+                C, = rule.productions[0].RHS
+                action = rule.productions[0].actions[-1]
+                if action[0] in identities and len (action) == 2:
+                    action = None
+                uses = 0
+                for other in gram.rules:
+                    for production in other.productions:
+                        if B not in production.RHS:  continue
+                        positions = [k for k, sym in enumerate (production.RHS) if sym == B]
+                        production.RHS = tuple ([sym == B and C or sym for sym in production.RHS])
+                        if action:
+                            outer = production.actions[-1]
+                            inlined = [(k, action) for k in positions] + list (outer[2:] and outer[2])
+                            production.actions[-1] = (outer[0], outer[1], inlined)
+                        uses += len (positions)
+                if uses:
+                    report.append ('inlined %s -> %s into %d uses'% (B, C, uses))
+                    changed = True
+
+        # Reachable nonterminals
+        reachable = [gram.startSymbol]
+        for lhs in reachable:
+            for production in rules[lhs].productions:
+                for sym in production.RHS:
+                    if sym in rules and sym not in reachable:
+                        reachable.append (sym)
+        for rule in list (gram.rules):
+            if rule.lhs not in reachable:
+                report.append ('removed unreachable nonterminal %s'% (rule.lhs))
+                gram.rules.remove (rule)
+        return report
+
+
+    @staticmethod
+    def analyze (gram):
+        '''Returns the tuple:
+
+        (
+          set (nullable nonterminals),
+          { nullable nonterminal : production deriving the empty string },
+          { nonterminal : [ productions predicted along with it ] },
+          { production : set (terminals that can start it) },
+        )
+
+        The productions predicted for a nonterminal M are those of every
+        nonterminal that can start a sentential form of M, i.e. appears
+        after a nullable prefix of a production of M or of one of those.
+        Call on a preprocessed GRAM.
+        '''
+        nullable = set ()
+        nullProductions = {}
+
+        # Nullable nonterminals, and the first production found to derive
+        # the empty string for each of them
+        changed = True
+        while changed:
+            changed = False
+            for rule in gram.rules:
+                if rule.lhs in nullable:  continue
+                for production in rule.productions:
+                    if all ([sym in nullable for sym in production.RHS]):
+                        nullable.add (rule.lhs)
+                        nullProductions[rule.lhs] = production
+                        changed = True
+                        break
+
+        # Prediction closures, in the order the productions would have been
+        # predicted one by one
+        rules = dict ([(rule.lhs, rule) for rule in gram.rules])
+        predictions = {}
+        for rule in gram.rules:
+            closure = [rule.lhs]
+            for lhs in closure:
+                for production in rules[lhs].productions:
+                    for sym in production.RHS:
+                        if sym in rules and sym not in closure:
+                            closure.append (sym)
+                        if sym not in nullable:
+                            break
+            predictions[rule.lhs] = [production for lhs in closure
+                                     for production in rules[lhs].productions]
+
+        # FIRST sets: the terminals that can start each nonterminal, and
+        # then each production
+        def firstOf (rhs):
+            result = set ()
+            for sym in rhs:
+                if sym not in rules:
+                    result.add (sym)
+                    break
+                result |= first[sym]
+                if sym not in nullable:
+                    break
+            return result
+        first = dict ([(lhs, set ()) for lhs in rules])
+        changed = True
+        while changed:
+            changed = False
+            for rule in gram.rules:
+                for production in rule.productions:
+                    new = firstOf (production.RHS)
+                    if not new <= first[rule.lhs]:
+                        first[rule.lhs] |= new
+                        changed = True
+        starts = dict ([(production, firstOf (production.RHS))
+                        for rule in gram.rules for production in rule.productions])
+
+        return nullable, nullProductions, predictions, starts
+
+
+    @staticmethod
+    def numberItems (gram):
+        '''Returns the tuple:
+
+        (
+          [ production of item ],
+          [ symbol after the dot of item, or None if item is complete ],
+          [ LHS of item ],
+          { production : item with the dot at the start },
+        )
+
+        An item is a production with a dot in its RHS.  The items of a
+        production P are numbered firstItem[P] + dot position.  Item 0 is
+        not used, so that 0 can stand for "no item".  Call on a
+        preprocessed GRAM.
+        '''
+        itemProd, itemSym, itemLHS = [None], [None], [None]
+        firstItem = {}
+        for rule in gram.rules:
+            for production in rule.productions:
+                firstItem[production] = len (itemProd)
+                for pos in xrange (len (production.RHS) + 1):
+                    itemProd.append (production)
+                    itemLHS.append (production.LHS)
+                    if pos < len (production.RHS):
+                        itemSym.append (production.RHS[pos])
+                    else:
+                        itemSym.append (None)
+        return itemProd, itemSym, itemLHS, firstItem
+
+
+    VAL_ARG = re.compile (r'\bn(\d+)\.val\b')
+    ARG = re.compile (r'\bn\d+\b')
+
+    @staticmethod
+    def makeSemantFunc (code, numArgs, sources):
+        '''Add the source of the semantic function for CODE to SOURCES and
+        return (name, direct) for it.  Once bound, the function is called
+        as f(None, v1, ..., vNUMARGS) with the values of the children.
+
+        CODE reads the value of child K as nK.val.  When that is all it
+        does with its arguments, nK.val is rewritten to plain nK and the
+        values are passed straight through (DIRECT); otherwise each value
+        is wrapped in an saObject first.
+        '''
         args = ['n0']
         for i in xrange (numArgs):
             args.append ('n%d'% (i+1))
+        direct = not EarleyParser.ARG.search (EarleyParser.VAL_ARG.sub ('', code))
+        if direct:
+            code = EarleyParser.VAL_ARG.sub (r'n\1', code)
+        name = util.uniqueIdentifier ()
+        sources.append ('def %s(%s):%s'% (name, ','.join (args), code))
+        return name, direct
+
+    @staticmethod
+    def bindSemantFuncs (gram, code):
+        '''Run CODE, which defines the semantic functions of GRAM, in a new
+        global object holding the grammar's imports, and replace the
+        (name, direct) actions of GRAM's productions with the functions.'''
+        # Import all the grammar's modules into a new global object
         try:
-            return util.createFunction (util.uniqueIdentifier (),
-                                        args, code, globalObject)
+            glob = util.doImports (gram.imports)
         except Exception, e:
-            util.error ("""couldn't create semantic function: """ + str(e))
+            util.error ('problem importing %s: %s' % (gram.imports, str(e)))
             sys.exit(1)
+        exec code in glob
+
+        def wrap (f):
+            def wrapped (n0, *values):
+                children = [saObject (val=v) for v in values]
+                return f (saObject (f, children), *children)
+            return wrapped
+
+        def function (action):
+            name, direct = action[:2]
+            f = glob[name] if direct else wrap (glob[name])
+            if len (action) == 2:
+                return f
+            inlined = [(k, function (inner)) for k, inner in action[2]]
+            def composed (n0, *values):
+                values = list (values)
+                for k, g in inlined:
+                    values[k] = g (None, values[k])
+                return f (n0, *values)
+            return composed
+
+        def bind (production):
+            actions = production.actions
+            for i, action in enumerate (actions):
+                if action:
+                    actions[i] = function (action)
+
+        for rule in gram.rules:
+            for production in rule.productions:
+                bind (production)
+                if production.operators:
+                    for operator in production.operators:
+                        bind (operator)
+                    production.actions[-1] = EarleyParser.makeClimber (production.operators)
+
+    @staticmethod
+    def makeClimber (operators):
+        '''Return the S-action of X -> @X.operators (see operatorRules):
+        it builds the chain of operands and OPERATORS, the bound binary
+        productions, into a tree by precedence climbing.  Higher operator
+        precedence binds tighter, and equal precedence groups by
+        associativity, as disambiguate does for the ambiguous productions.
+        An operator without a precedence, such as 'in', goes the way
+        disambiguate's first-found rule sends it.  Its right operand is
+        just the next operand.  Its left operand is the whole left operand
+        of the declared operator that follows it, or the whole chain so far
+        at the end.  So 'a + b in c + d' is ((a + b) in c) + d, but
+        'a + b in c * d' is a + ((b in c) * d).  The tree is built with an
+        explicit stack, and each operator's S-action is called on (left,
+        lexeme, right).
+        '''
+        table = [(p.info[0], p.info[1] and p.info[1][0] == 'right', p.actions[-1])
+                 for p in operators]
+
+        def climb (n0, chain):
+            links = []
+            while len (chain) == 4:
+                links.append (chain)
+                chain = chain[0]
+            values = [chain[0]]
+            pending = []        # (precedence, right assoc., S-action, lexeme)
+            undeclared = []     # (S-action, lexeme, right operand) since the last operator
+            for chain, i, lexeme, right in reversed (links):
+                prec, rightAssoc, f = table[i]
+                if prec is None:
+                    undeclared.append ((f, lexeme, right))
+                    continue
+                while pending and (pending[-1][0] > prec or
+                                   (pending[-1][0] == prec and not rightAssoc)):
+                    top = pending.pop ()
+                    value = values.pop ()
+                    values[-1] = top[2] (None, values[-1], top[3], value)
+                for g, operator, operand in undeclared:
+                    values[-1] = g (None, values[-1], operator, operand)
+                del undeclared[:]
+                pending.append ((prec, rightAssoc, f, lexeme))
+                values.append (right)
+            while pending:
+                top = pending.pop ()
+                value = values.pop ()
+                values[-1] = top[2] (None, values[-1], top[3], value)
+            for g, operator, operand in undeclared:
+                values[0] = g (None, values[0], operator, operand)
+            return values[0]
+        return climb
+
+##-----------------------------------------------------------------------------
+## LALR(1) Parser
+##
+class LALRParser:
+    '''A deterministic LALR(1) parser for the grammar of an EarleyParser,
+    sharing its preprocessed grammar, lexer and semantic functions.
+
+    Shift/reduce conflicts are settled from the grammar's %left/%right and
+    %dprec declarations, the way EarleyParser.parse's disambiguate would
+    pick between the two parse trees.  The conflicts they leave (the
+    grammar is not LALR(1): 'def f(x)' needs to see past the ')') are
+    settled while parsing, by trying each action on a copy of the stacks
+    up to the end of the input at hand and keeping the one that survives.
+
+    When more than one survives, the input is ambiguous.  With FALLBACK
+    set (the 'hybrid' parser) such a statement, and one with a syntax
+    error, is handed to the Earley parser, so the result is always what
+    the Earley parser would have produced.  Without it (the 'lalr'
+    parser), ambiguities go yacc's way -- shift over reduce, and the
+    earlier production among reductions -- and syntax errors are
+    reported directly.
+    '''
+
+    END = '$end'            # the lookahead at the end of the input
+    ACCEPT = 'accept'       # action of the start state on END, once S is reduced
+    CONFLICT = 'conflict'   # action of an unsettled conflict; see conflicts
+
+    def __init__ (self, earley, fallback=False, tables=None):
+        '''Create a new LALR(1) parser over EARLEY, an EarleyParser, from
+        TABLES, the result of LALRParser.buildTables on its grammar.'''
+        if tables is None:
+            tables = LALRParser.buildTables (earley.grammar)
+        self.earley = earley
+        self.fallback = fallback
+        self.grammar = earley.grammar
+        self.terminals = earley.terminals
+        self.invRenamedTerminals = earley.invRenamedTerminals
+        self.lexer = earley.lexer
+
+        productions, action, self.goto, self.conflicts = tables
+        functions = [None] + [production.actions[-1] for rule in self.grammar.rules
+                              for production in rule.productions]
+        self.productions = [(lhs, n, f) for (lhs, n), f in zip (productions, functions)]
+        self.action = [dict (acts) for acts in action]
+        for acts in self.action:
+            if LALRParser.END in acts and acts[LALRParser.END] == LALRParser.ACCEPT:
+                acts[LALRParser.END] = LALRParser.ACCEPT    # parse() tests it with 'is'
+        for state, sym in self.conflicts:
+            self.action[state][sym] = LALRParser.CONFLICT
+
+        self.statements = 0         # statements parsed
+        self.trials = 0             # conflicts settled by trying each action
+        self.fallbacks = 0          # statements handed to the Earley parser
+        self.parsedepth = 0         # how many parsers in are we?
+
+    def tokenize (self, inp):
+        '''Return the tokenized version of INP, a sequence of
+        (token, lexeme) pairs.
+        '''
+        return self.earley.tokenize (inp)
+
+    def recognize (self, inp):
+        '''See EarleyParser.recognize; recognizing needs no tables.'''
+        return self.earley.recognize (inp)
+
+    def dump (self, f=sys.stdout):
+        self.earley.dump (f)
+
+    def parse (self):
+        '''The same coroutine protocol as EarleyParser.parse: prime it with
+        next(), then send the tokens of each line, getting back None while
+        the statement is incomplete and its AST once it is done.  Text sent
+        instead of tokens is tokenized here, in one go.'''
+        action, goto, productions = self.action, self.goto, self.productions
+        ACCEPT, CONFLICT, END = LALRParser.ACCEPT, LALRParser.CONFLICT, LALRParser.END
+
+        # Shift KIND, after making the reductions it calls for, on the
+        # stacks STATES and VALUES; ACT, if given, replaces the first
+        # action looked up.  Returns True once shifted, ACCEPT, False on a
+        # syntax error and CONFLICT on an unsettled conflict.
+        def step(states, values, kind, lexeme, act=None):
+            while True:
+                if act is None:
+                    act = action[states[-1]].get(kind)
+                    if act is None:
+                        return False
+                    if act is CONFLICT or act is ACCEPT:
+                        return act
+                if act >= 0:
+                    states.append(act)
+                    values.append(lexeme)
+                    return True
+                lhs, n, f = productions[-act-1]
+                if n:
+                    args = values[-n:]
+                    del values[-n:]
+                    del states[-n:]
+                else:
+                    args = [None]
+                values.append(f(None, *args))
+                states.append(goto[states[-1]][lhs])
+                act = None
+
+        # Step over inp[pos:] and then, if KIND is END, over the end of the
+        # input; ACT as in step.  Returns (result of the last step, position).
+        def run(states, values, pos, kind=None, act=None):
+            while pos < len(inp):
+                result = step(states, values, inp[pos][0], inp[pos][1], act)
+                if result is not True:
+                    return result, pos
+                pos += 1
+                act = None
+            if kind is END:
+                return step(states, values, END, None, act), pos
+            return True, pos
+
+        # Try each action of the conflict at inp[pos] (at the end of the
+        # input past it) on copies of the stacks, forking again at each
+        # conflict the copies run into.  The copies are stepped over the
+        # input together, token by token, until all that are left come from
+        # the same action, or the input (and then, if KIND is END, the end
+        # of it) runs out.  Returns the actions left, in yacc's order, and
+        # the state stacks they got to, [(action, [states])].
+        def trial(states, values, pos, kind):
+            self.trials += 1
+            la = inp[pos][0] if pos < len(inp) else END
+            order = self.conflicts[(states[-1], la)]
+            paths = [(act, list(states), list(values), act) for act in order]
+            while len(set([path[0] for path in paths])) > 1:
+                if pos < len(inp):
+                    la, lexeme = inp[pos]
+                elif pos == len(inp) and kind is END:
+                    la, lexeme = END, None
+                else:
+                    break
+                work, paths, seen = paths, [], set()
+                while work:
+                    first, s, v, act = work.pop()
+                    result = step(s, v, la, lexeme, act)
+                    if result is CONFLICT:
+                        for act in self.conflicts[(s[-1], la)]:
+                            work.append((first, list(s), list(v), act))
+                    elif result is not False and (first, tuple(s)) not in seen:
+                        seen.add((first, tuple(s)))
+                        paths.append((first, s, v, None))
+                pos += 1
+            survivors = dict([(first, []) for first, s, v, act in paths])
+            for first, s, v, act in paths:
+                survivors[first].append(s)
+            return [(act, survivors[act]) for act in order if act in survivors]
+
+        # Whether paths from different actions among SURVIVORS of a trial
+        # have got to the same stacks, and so can only both succeed: the
+        # input is ambiguous if it is a statement at all
+        def met(survivors):
+            seen = set()
+            for act, stacks in survivors:
+                stacks = set([tuple(s) for s in stacks])
+                if seen & stacks:
+                    return True
+                seen |= stacks
+            return False
+
+        # put this here for the initial next() call required by Python coroutines
+        self.parsedepth = 0
+        inp = (yield "Prepped for parse-off, cap'n!")
+        if isinstance(inp, basestring):
+            inp = self.tokenize(inp)
+        self.parsedepth += 1
+        self.statements += 1
+
+        states = [0]            # stack of LR states
+        values = []             # semantic values of the symbols between them
+        pos = 0
+        result, pos = run(states, values, pos)
+        while True:
+            while result is CONFLICT:
+                survivors = trial(states, values, pos, None)
+                if len(survivors) > 1 and not met(survivors):
+                    result = True       # stay at the conflict until more input settles it
+                elif len(survivors) > 1 and self.fallback:
+                    break               # ambiguous
+                elif survivors:
+                    result, pos = run(states, values, pos, None, survivors[0][0])
+                else:
+                    result = False
+            if result is CONFLICT:
+                break
+            if result is False:
+                if self.fallback:
+                    break
+                self.parsedepth = self.parsedepth - 1
+                if pos < len(inp):
+                    raise SyntaxError('Bad syntax at token %d: %s' % (pos, inp[pos][1]))
+                raise SyntaxError('Bad syntax at token %d: %s' % (pos - 1, inp[pos - 1][1]))
+
+            # All of the input is in.  The statement is done if it can end
+            # here; try that on copies of the stacks, as it may yet go on.
+            endStates, endValues = list(states), list(values)
+            result, p = run(endStates, endValues, pos, END)
+            while result is CONFLICT:
+                survivors = trial(endStates, endValues, p, END)
+                if len(survivors) > 1 and self.fallback:
+                    break               # ambiguous
+                elif survivors:
+                    result, p = run(endStates, endValues, p, END, survivors[0][0])
+                else:
+                    result = False
+            if result is CONFLICT:
+                break
+            if result is ACCEPT:
+                self.parsedepth = self.parsedepth - 1
+                yield endValues[-1]
+                return
+
+            line = (yield None)         # wait for more input
+            if isinstance(line, basestring):
+                line = self.tokenize(line)
+            inp = inp + line
+            result, pos = run(states, values, pos)
+
+        # Hand the statement to the Earley parser, which also reports
+        # syntax errors exactly as it always has
+        self.fallbacks += 1
+        parser = self.earley.parse()
+        parser.next()
+        try:
+            ast = parser.send(inp)
+            while ast is None:
+                line = (yield None)
+                ast = parser.send(line)
+        finally:
+            self.parsedepth = self.parsedepth - 1
+        yield ast
+
+
+    ##---  STATIC  ------------------------------------------------------------
+
+    @staticmethod
+    def buildTables (gram):
+        '''Returns the tuple:
+
+        (
+          [ (LHS, len (RHS)) ],                 # productions, by number
+          [ { symbol : action } ],              # by state
+          [ { nonterminal : state } ],          # by state
+          { (state, symbol) : [ actions ] },    # unsettled conflicts
+        )
+
+        An action is a state to shift to, -(number+1) of a production to
+        reduce, or ACCEPT.  Call on a preprocessed and bound GRAM.
+
+        The LR(0) automaton is built first; its lookaheads are then found
+        by propagation from the kernel items, as in the dragon book
+        (Aho, Sethi & Ullman, algorithm 4.13).
+        '''
+        END = LALRParser.END
+        rules = dict ([(rule.lhs, rule) for rule in gram.rules])
+
+        # Production 0 is the augmented start production $accept -> S
+        prods = [('$accept', (gram.startSymbol,), None)]
+        byLHS = {}
+        for rule in gram.rules:
+            for production in rule.productions:
+                byLHS.setdefault (rule.lhs, []).append (len (prods))
+                prods.append ((rule.lhs, tuple (production.RHS), production))
+
+        # FIRST sets of the nonterminals
+        nullable = set ()
+        first = dict ([(lhs, set ()) for lhs in rules])
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, production in prods[1:]:
+                for sym in rhs:
+                    new = first[sym] if sym in rules else set ([sym])
+                    if not new <= first[lhs]:
+                        first[lhs] |= new
+                        changed = True
+                    if sym not in nullable:
+                        break
+                else:
+                    if lhs not in nullable:
+                        nullable.add (lhs)
+                        changed = True
+
+        def firstOf (syms, la):
+            result = set ()
+            for sym in syms:
+                if sym not in rules:
+                    result.add (sym)
+                    return result
+                result |= first[sym]
+                if sym not in nullable:
+                    return result
+            result.add (la)
+            return result
+
+        def closure0 (kernel):
+            items = list (kernel)
+            seen = set (items)
+            for p, dot in items:
+                rhs = prods[p][1]
+                if dot < len (rhs) and rhs[dot] in rules:
+                    for q in byLHS[rhs[dot]]:
+                        if (q, 0) not in seen:
+                            seen.add ((q, 0))
+                            items.append ((q, 0))
+            return items
+
+        # LR(1) closure of {(item, la)}: returns {item : set (la)}
+        def closure1 (kernel):
+            result = {}
+            work = []
+            for item, las in kernel:
+                result.setdefault (item, set ()).update (las)
+                work.append (item)
+            while work:
+                p, dot = work.pop ()
+                rhs = prods[p][1]
+                if dot < len (rhs) and rhs[dot] in rules:
+                    las = set ()
+                    for la in result[(p, dot)]:
+                        las |= firstOf (rhs[dot+1:], la)
+                    for q in byLHS[rhs[dot]]:
+                        old = result.setdefault ((q, 0), set ())
+                        if not las <= old:
+                            old |= las
+                            work.append ((q, 0))
+            return result
+
+        # LR(0) automaton
+        kernels = [((0, 0),)]
+        stateOf = {kernels[0]: 0}
+        transitions = []
+        for kernel in kernels:
+            moves = {}
+            for p, dot in closure0 (kernel):
+                rhs = prods[p][1]
+                if dot < len (rhs):
+                    moves.setdefault (rhs[dot], []).append ((p, dot+1))
+            edges = {}
+            for sym, items in moves.iteritems ():
+                target = tuple (sorted (items))
+                if target not in stateOf:
+                    stateOf[target] = len (kernels)
+                    kernels.append (target)
+                edges[sym] = stateOf[target]
+            transitions.append (edges)
+
+        # Lookaheads of the kernel items: spontaneous ones, and the
+        # propagation links between kernel items
+        DUMMY = '$#'
+        lookaheads = [dict ([(item, set ()) for item in kernel]) for kernel in kernels]
+        lookaheads[0][(0, 0)].add (END)
+        links = {}
+        for s, kernel in enumerate (kernels):
+            for item in kernel:
+                for (p, dot), las in closure1 ([(item, [DUMMY])]).iteritems ():
+                    rhs = prods[p][1]
+                    if dot == len (rhs):
+                        continue
+                    target = (transitions[s][rhs[dot]], (p, dot+1))
+                    for la in las:
+                        if la == DUMMY:
+                            links.setdefault ((s, item), []).append (target)
+                        else:
+                            lookaheads[target[0]][target[1]].add (la)
+        changed = True
+        while changed:
+            changed = False
+            for (s, item), targets in links.iteritems ():
+                las = lookaheads[s][item]
+                for t, titem in targets:
+                    if not las <= lookaheads[t][titem]:
+                        lookaheads[t][titem] |= las
+                        changed = True
+
+        # The tables, settling conflicts from precedence where possible
+        action = []
+        goto = []
+        conflicts = {}
+        for s, kernel in enumerate (kernels):
+            items = closure1 ([(item, lookaheads[s][item]) for item in kernel])
+            shifts = {}         # terminal -> productions shifting it
+            reduces = {}        # terminal -> productions to reduce
+            for (p, dot), las in items.iteritems ():
+                rhs = prods[p][1]
+                if dot < len (rhs):
+                    if rhs[dot] not in rules:
+                        shifts.setdefault (rhs[dot], []).append (p)
+                elif p == 0:
+                    reduces.setdefault (END, []).append (p)
+                else:
+                    for la in las:
+                        reduces.setdefault (la, []).append (p)
+
+            acts = {}
+            for sym, ps in shifts.iteritems ():
+                acts[sym] = transitions[s][sym]
+            for la, ps in reduces.iteritems ():
+                ps.sort ()
+                if ps == [0]:
+                    acts[la] = LALRParser.ACCEPT
+                    continue
+                choice = -(ps[0]+1)
+                settled = len (ps) == 1
+                if la in shifts:
+                    resolved = LALRParser.resolve (prods[ps[0]], [prods[q] for q in shifts[la]])
+                    if resolved is None or not settled:
+                        choice = acts[la]       # yacc's default: shift
+                        settled = False
+                    elif resolved == 'shift':
+                        choice = acts[la]
+                if not settled:
+                    conflicts[(s, la)] = [acts[la] for sym in [la] if sym in shifts] + \
+                                       [-(p+1) for p in ps]
+                acts[la] = choice
+            action.append (acts)
+            goto.append (dict ([(sym, t) for sym, t in transitions[s].iteritems ()
+                                if sym in rules]))
+
+        productions = [(lhs, len (rhs)) for lhs, rhs, production in prods]
+        return productions, action, goto, conflicts
+
+    @staticmethod
+    def resolve (reduce, shifts):
+        '''Settle the shift/reduce conflict between the production REDUCE
+        and the productions SHIFTS with the terminal after the dot, all
+        (LHS, RHS, Production).  Returns 'shift', 'reduce' or None.
+
+        Reducing puts REDUCE below the shifted production in the tree, and
+        shifting puts it above, so this picks whichever tree disambiguate
+        would: the lower operator precedence on top, then associativity,
+        then the higher %dprec on top.  Only productions of the same
+        nonterminal compete there; anything else is left unsettled.
+        '''
+        lhs = reduce[0]
+        if [s for s in shifts if s[0] != lhs]:
+            return None
+        opPrec, assoc, dprec = reduce[2].info[:3]
+        others = set ([s[2].info[:3] for s in shifts])
+        if len (others) != 1:
+            return None
+        opPrec2, assoc2, dprec2 = others.pop ()
+
+        if opPrec != None and opPrec2 != None:
+            if opPrec != opPrec2:
+                return 'shift' if opPrec < opPrec2 else 'reduce'
+            elif assoc[0] == 'left' and assoc2[0] == 'left':
+                return 'reduce'
+            elif assoc[0] == 'right' and assoc2[0] == 'right':
+                return 'shift'
+            return None
+        elif dprec != None and dprec2 != None and dprec != dprec2:
+            return 'shift' if dprec > dprec2 else 'reduce'
+        return None
 
 if __name__ == '__main__':
     pass
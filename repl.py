@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import curses, sys, textwrap, re, os
+import curses, sys, textwrap, re, os, bisect, multiprocessing
 import parser_generator, interpreter, grammar_parser
 
 cs164b_builtins = ["def", "error", "print", "if", "while", "for", "in", "null", "len", "lambda", "type", "native", "ite", "coroutine", "resume", "yield", "&&", "||", "<=", ">=", "==", "!="]
@@ -7,11 +7,103 @@ greetings = ["Welcome to cs164b!","To exit, hit <Ctrl-d>.","Press F2 to see the
 PROMPTSTR =   "cs164b> "
 CONTINUESTR = "    ... "
 
+# The tokens of the line being edited, kept up to date incrementally.
+# Each keystroke only relexes the text around the edit: the tokens in front
+# of it are kept, and as soon as the lexer lands on a token boundary in the
+# unchanged tail of the line, the old tokens from there on are reused.  Each
+# span carries its color, so the highlighter repaints straight from it.
+class TokenBuffer:
+    def __init__(self, lexer, colorOf):
+        self.lexer = lexer          # a parser_generator.Lexer
+        self.colorOf = colorOf      # (lhs, lexeme) -> (color, attr)
+        self.text = ""
+        self.spans = []             # [(lhs, start, end, lexeme, color, attr)]; lhs is None for ignored text
+        self.starts = []            # start and end of each span, for bisecting
+        self.ends = []
+        self.error = False          # True if the text doesn't tokenize
+        self._tokens = []
+
+    # the (token, lexeme) pairs of the line, as tokenize() would return them
+    def getTokens(self):
+        if self._tokens is None:
+            self._tokens = [(span[0], span[3]) for span in self.spans if span[0]]
+        return self._tokens
+    tokens = property(getTokens)
+
+    QUOTES = '\'"'      # the first characters of string tokens
+
+    def update(self, text):
+        if text == self.text:
+            return
+        try:
+            self.spans, self.error = self.relex(text, self.error), False
+        except NameError:
+            # the edit may have changed a token further back than relex
+            # looked; only the whole line can tell
+            try:
+                self.spans, self.error = self.relex(text, True), False
+            except NameError:
+                self.spans, self.error = [], True
+
+        self.text = text
+        self.starts = [span[1] for span in self.spans]
+        self.ends = [span[2] for span in self.spans]
+        self._tokens = None
+
+    # the spans of text, relexing only the part of it the last edit can
+    # have changed, or all of it if whole.  raises NameError if text
+    # doesn't tokenize
+    def relex(self, text, whole=False):
+        old, spans, starts, ends = self.text, self.spans, self.starts, self.ends
+        if whole:
+            spans, starts, ends = [], [], []
+
+        # the edit replaced old[p:len(old)-s] by text[p:len(text)-s]
+        p = commonPrefix(old, text)
+        s = commonSuffix(old[p:], text[p:])
+        delta = len(text) - len(old)
+        tail = len(text) - s
+
+        # keep the tokens that end before the edit, less one: a token's
+        # extent may depend on the character that follows it.  and none
+        # from the first string on: with escaped quotes, the edit may
+        # change where a string that starts far back ends
+        keep = max(bisect.bisect_left(ends, p) - 1, 0)
+        for i in xrange(keep):
+            if spans[i][3][0] in TokenBuffer.QUOTES:
+                keep = i
+                break
+        new = spans[:keep]
+        pos = spans[keep][1] if keep < len(spans) else 0
+
+        while True:
+            # back in sync with the old tokens? then reuse the rest of them
+            if pos >= tail:
+                i = bisect.bisect_left(starts, pos - delta, keep)
+                if i < len(starts) and starts[i] == pos - delta:
+                    new.extend([(lhs, start + delta, end + delta, lexeme, color, attr)
+                                for lhs, start, end, lexeme, color, attr in spans[i:]])
+                    return new
+
+            lhs, end = self.lexer.scan(text, pos)
+            if pos == len(text):
+                if lhs:
+                    new.append(self.span(lhs, pos, end, text[pos:end]))
+                return new
+            elif pos == end or lhs == 0:        # 0-length match, or no match
+                raise NameError, pos
+            new.append(self.span(lhs, pos, end, text[pos:end]))
+            pos = end
+
+    def span(self, lhs, start, end, lexeme):
+        color, attr = self.colorOf(lhs, lexeme)
+        return (lhs, start, end, lexeme, color, attr)
+
 class cs164bRepl:
     def __init__(self):
         #initialize parser
         cs164grammarFile = './cs164b.grm'
-        self.cs164bparser = parser_generator.makeParser(grammar_parser.parse(open(cs164grammarFile).read()))
+        self.cs164bparser = parser_generator.makeParser(open(cs164grammarFile).read(), 'hybrid')
 
         # vars for file saving
         self.history = []           # history of succesfully executed lines
@@ -32,6 +124,9 @@ class cs164bRepl:
         self.parser.next()
         self.colorMap = {}
 
+        # tokens of the line being edited, shared by the highlighter and tab-completion
+        self.lineBuffer = TokenBuffer(self.cs164bparser.lexer, self.tokenColor)
+
         #initialize curses
         self.screen = curses.initscr()
         curses.start_color()
@@ -59,7 +154,7 @@ class cs164bRepl:
         self.cursorx = 0
 
     # quick macro for loading in a file, based on the line-by-line parser model.
-    def loadProgram(self, p_file):
+    def loadProgram(self, p_file, processes=None):
         #message to return
         message = ""
 
@@ -67,47 +162,27 @@ class cs164bRepl:
         history = self.history[:]
         lineNumber = self.curLineNumber
 
-        # grab the token for a newline so we know how to pad our lines
-        newline = self.cs164bparser.tokenize("\n")
-
         # load in the program file
         try:
-            prog = re.findall('[^\r\n;]+', re.sub("#.*\r?\n", "", open(p_file).read()))
+            prog = programLines(open(p_file).read())
         except IOError, e:
             message = "Error opening file!"
             return (False, message)
 
-        # initialize a parser instance, i.e., a coroutine, and prep it
-        parser = self.cs164bparser.parse()
-        parser.next()
+        # parse it all up front (on several processes, if it's big enough),
+        # then run the statements in order
+        try:
+            asts, error = parseProgram(self.cs164bparser, prog, processes)
+        except KeyboardInterrupt:
+            asts, error = [], (None, "Execution terminated by user while loading file: " + p_file)
 
-        # no newline insert before the first line of a statement
-        first_line = True
         success = True
-        for l in prog:
+        for input_ast in asts:
             try:
-                tokens = self.cs164bparser.tokenize(l)
-                if tokens:                              # no need to consume non-code lines
-                    if not first_line:                  # separate lines w/ newline characters
-                        tokens = newline + tokens
-                    input_ast = parser.send(tokens)     # parse this line
-                    first_line = False
-                    if type(input_ast) == tuple:        # parsing completed on this line; execute result
-                        self.exec_fail = False
-                        interpreter.ExecGlobalStmt(input_ast, self)
-                        if self.exec_fail:
-                            raise Exception
-
-                        # create and prep a new parser instance
-                        parser = self.cs164bparser.parse()
-                        parser.next()
-                        first_line = True
-
-            # soft failure - if there's an error, print a helpful message and create a new parser
-            except SyntaxError, e:
-                message = "Error while parsing line: " + l + "\n" + e.msg
-                success = False
-                break
+                self.exec_fail = False
+                interpreter.ExecGlobalStmt(input_ast, self)
+                if self.exec_fail:
+                    raise Exception
             except KeyboardInterrupt:
                 message = "Execution terminated by user while loading file: " + p_file
                 success = False
@@ -115,6 +190,15 @@ class cs164bRepl:
             except Exception:
                 success = False
                 break
+        else:
+            # soft failure - if there's an error, print a helpful message
+            if error:
+                l, msg = error
+                if msg is not None and l is not None:
+                    message = "Error while parsing line: " + l + "\n" + msg
+                elif msg is not None:
+                    message = msg
+                success = False
 
         # restore history
         self.history = history
@@ -193,33 +277,30 @@ class cs164bRepl:
                 tokenCode = self.cs164bparser.tokenize(token)[0][0]
                 self.colorMap[tokenCode] = (colorNumber, attr)
 
+    def tokenColor(self, code, string):
+        if code is None and string.startswith('#'):
+            return (6, curses.A_NORMAL)                 # comments
+        return self.colorMap.get(code, (0, curses.A_NORMAL))
+
     def updateCurrentLine(self, s, tab=False, stringCompletion=False, interruptFlag=False):
 
         width = self.screen.getmaxyx()[1] - 6
         padding = width - len(PROMPTSTR)
 
-        # separate out any comments before doing anything else
-        comment = ""
-        comment_pos = s.find('#')
-        if comment_pos >= 0:
-            s, comment = s[:comment_pos], s[comment_pos:]
+        # relex the edited part of the line
+        self.lineBuffer.update(s)
 
         # disregard tokens, acquire suggestions
         suggestions = {}
-        try:
-            if interruptFlag:
-                raise NameError
-            lineTokens = self.cs164bparser.tokenize(s)
-            if lineTokens:
-                suggestions = self.getSuggestions(lineTokens)
-        except NameError, e:
-            lineTokens = []
-
+        if interruptFlag or self.lineBuffer.error:
             self.screen.addstr(self.curLineNumber, len(PROMPTSTR), s, curses.color_pair(1))
             self.screen.addstr(self.curLineNumber, len(s)+len(PROMPTSTR), padding * ' ')
             self.clearBox(self.infoBox)
             self.screen.move(self.curLineNumber, len(s)+len(PROMPTSTR))
             return
+        lineTokens = self.lineBuffer.tokens
+        if lineTokens:
+            suggestions = self.getSuggestions()
 
         if tab:
             if not self.inTab:
@@ -238,11 +319,9 @@ class cs164bRepl:
             selectedSuggestion = self.currentSuggestions[self.suggestionsIndex]
             s = s + selectedSuggestion[self.fragmentIndex:]
             self.suggestedLine = s
-            #retokenize to account for the new item
-            try:
-                lineTokens = self.cs164bparser.tokenize(s)
-            except NameError, e:
-                lineTokens = []
+            #relex to account for the new item
+            self.lineBuffer.update(s)
+            if self.lineBuffer.error:
                 self.screen.addstr(self.curLineNumber, len(PROMPTSTR), s, curses.color_pair(1))
                 self.screen.addstr(self.curLineNumber, len(s)+len(PROMPTSTR), padding * ' ')
                 self.clearBox(self.infoBox)
@@ -256,34 +335,11 @@ class cs164bRepl:
             else:
                 suggestions = {}
 
-        #generate color/string/attr triples, store into stringColorPairs
-        stringColorPairs = []
-        for code, string in lineTokens:
-            color, attr = self.colorMap.get(code,(0, curses.A_NORMAL))
-            stringColorPairs.append((string, color, attr))
-
-        x_pos = len(PROMPTSTR)
-        str_index = 0
-
-        #loop that prints each token in different colors
-        for string, colorNumber, attr in stringColorPairs:
-            #print remaining part of string in neutral color first
-            self.screen.addstr(self.curLineNumber, x_pos, s[str_index:s.find(string, str_index)], curses.color_pair(0))
-            x_pos += s.find(string, str_index) - str_index
-            str_index = s.find(string, str_index)
-            self.screen.addstr(self.curLineNumber, x_pos, string, curses.color_pair(colorNumber) | attr) #bold/underline?
-            x_pos += len(string)
-            str_index += len(string)
-
-        #print rest of string if we're not done
-        if (str_index != len(s)):
-            self.screen.addstr(self.curLineNumber, x_pos, s[str_index:], curses.color_pair(0))
+        #print each token (and the ignored text between them) in its color
+        for code, start, end, string, colorNumber, attr in self.lineBuffer.spans:
+            self.screen.addstr(self.curLineNumber, len(PROMPTSTR) + start, string, curses.color_pair(colorNumber) | attr)
         x_pos = len(PROMPTSTR) + len(s)
 
-        # print any comments, if they're there
-        self.screen.addstr(self.curLineNumber, x_pos, comment, curses.color_pair(6))
-        x_pos += len(comment)
-
         self.screen.addstr(self.curLineNumber, x_pos, padding * ' ')
         self.showSuggestions(suggestions)
         self.screen.move(self.curLineNumber, x_pos) #move cursor to end of line
@@ -338,7 +394,9 @@ class cs164bRepl:
         else:
             return None
 
-    def getSuggestions(self, tokens):
+    # tab-completion results for the token buffer of the current line
+    def getSuggestions(self):
+        tokens = self.lineBuffer.tokens
 
         def findFunctionalUnit(tokens):
             if not tokens:                                              # can't fill the hole in your heart, I mean, code
@@ -568,12 +626,12 @@ class cs164bRepl:
                     self.cursorx += 1
                     hist_ptr = 0
                     history[hist_ptr] = line                    # and save the line so far
-                    try:
-                        lineTokens = self.cs164bparser.tokenize(line)
-                    except NameError, e:
-                        lineTokens = []
 
                 elif i == ord('\n'):                            # EOL characters
+                    try:                                        # tokens of the finished line, lexed afresh
+                        lineTokens = self.cs164bparser.tokenize(line)
+                    except NameError:
+                        lineTokens = []
                     self.screen.addch(i)
                     line += chr(i)                              # add to the current buffer
                     self.cursorx = 0
@@ -636,7 +694,7 @@ class cs164bRepl:
                         line = strInsert(line, '\t', self.cursorx)
                         self.cursorx += 1
                     else:
-                        suggestions = self.getSuggestions(lineTokens)
+                        suggestions = self.getSuggestions()
                         if (type(suggestions) == dict and suggestions) or (type(suggestions) == tuple and suggestions[2]):
                             tab = True
                         else:
@@ -681,6 +739,28 @@ class cs164bRepl:
                 first_line = True
                 hist_ptr = 0
 
+# length of the longest common prefix of a and b, found by comparing slices
+def commonPrefix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+# same deal as above, for the longest common suffix
+def commonSuffix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a)-mid:] == b[len(b)-mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
 # because python strings are annoyingly immutable
 def strInsert(original, new, pos):
     # inserts new inside original at pos
@@ -691,6 +771,119 @@ def strInsert(original, new, pos):
 def strRemove(original, pos):
     return original[:pos] + original[pos+1:]
 
+# Loading a program
+#
+# A program file is split into lines at newlines and semicolons, after
+# dropping comments, and fed to the parser a line at a time, the same way
+# the prompt feeds it.  Big files are cut into chunks at lines where no
+# bracket is left open -- almost always the end of a statement -- and the
+# chunks are parsed on a pool of processes.  A chunk that doesn't end where
+# a statement does is caught when the results are put back together, and
+# the lines from there are parsed again here, so the outcome is always
+# exactly that of parsing the file line by line.
+
+PARALLEL_LINES = 2000   # smallest file worth starting a pool of processes for
+CHUNK_LINES = 200       # lines per chunk, about
+
+# lines of the program TEXT, as they are sent to the parser
+def programLines(text):
+    return re.findall('[^\r\n;]+', re.sub("#.*\r?\n", "", text))
+
+# parse LINES with PARSER, starting a new statement, as the prompt would.
+# returns (asts, pending, error): the ASTs of the statements completed, the
+# lines of the statement left incomplete at the end, and (line, message)
+# for the error that stopped the parse, if any -- message is None unless
+# it was a syntax error
+def parseLines(parser, lines):
+    newline = parser.tokenize("\n")
+    asts, pending = [], []
+    coroutine = None
+    for l in lines:
+        try:
+            tokens = parser.tokenize(l)
+            if not tokens:                          # no need to consume non-code lines
+                continue
+            if coroutine is None:                   # no newline before the first line of a statement
+                coroutine = parser.parse()
+                coroutine.next()
+            else:
+                tokens = newline + tokens
+            pending.append(l)
+            ast = coroutine.send(tokens)
+            if type(ast) == tuple:
+                asts.append(ast)
+                pending = []
+                coroutine = None
+        except SyntaxError, e:
+            return asts, pending, (l, e.msg)
+        except Exception:
+            return asts, pending, (l, None)
+    return asts, pending, None
+
+# cut LINES into chunks of about CHUNK_LINES lines, each ending on a line
+# that closes every bracket opened since the chunk began
+def programChunks(parser, lines, size=CHUNK_LINES):
+    opens = set([t[0][0] for t in map(parser.tokenize, "([{")])
+    closes = set([t[0][0] for t in map(parser.tokenize, ")]}")])
+    chunks = [[]]
+    depth = 0
+    for l in lines:
+        chunks[-1].append(l)
+        try:
+            tokens = parser.tokenize(l)
+        except Exception:
+            tokens = []                             # it'll fail again when parsed
+        for kind, lexeme in tokens:
+            if kind in opens:
+                depth += 1
+            elif kind in closes:
+                depth -= 1
+        if depth <= 0:
+            depth = 0
+            if len(chunks[-1]) >= size:
+                chunks.append([])
+    return [chunk for chunk in chunks if chunk]
+
+# the parser of each process in the pool; the processes are forked from
+# this one after it is set, so they share the grammar and tables
+workerParser = None
+
+def parseChunk(lines):
+    return parseLines(workerParser, lines)
+
+# parse the program LINES with PARSER: returns (asts, error), the ASTs of
+# its statements in order and the error that stopped the parse, as from
+# parseLines.  a big enough program is parsed on PROCESSES processes (by
+# default, one per CPU); an incomplete statement at the end is dropped
+def parseProgram(parser, lines, processes=None):
+    global workerParser
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(lines) < PARALLEL_LINES:
+        asts, pending, error = parseLines(parser, lines)
+        return asts, error
+
+    chunks = programChunks(parser, lines, min(CHUNK_LINES, len(lines) // processes + 1))
+    workerParser = parser
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap(parseChunk, chunks)
+        asts = []
+        pending = []        # lines of a statement running on from the chunks before
+        for chunk in chunks:
+            result = results.next()
+            if pending:
+                # the chunk started mid-statement, so its result is no good
+                result = parseLines(parser, pending + chunk)
+            chunkAsts, pending, error = result
+            asts.extend(chunkAsts)
+            if error:
+                return asts, error
+        return asts, None
+    finally:
+        pool.terminate()
+        workerParser = None
+
 if __name__ == "__main__":
     repl = cs164bRepl()
 
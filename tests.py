@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+##
+# @file tests.py
+#
+# Regression tests for the cs164b parser and interpreter.
+#
+# Usage: python tests.py [-v] [TestCase[.test] ...]
+# (or python -m unittest discover)
+import sys, os, re, random, unittest
+import parser_generator, grammar_parser
+
+os.chdir (os.path.dirname (os.path.abspath (__file__)))
+
+GRAMMAR_FILE = './cs164b.grm'
+
+parsers = {}
+
+def makeParser (type='earley'):
+    '''The parser of TYPE for cs164b.grm, made once for all the tests.'''
+    if type not in parsers:
+        parsers[type] = parser_generator.makeParser (open (GRAMMAR_FILE).read (), type)
+    return parsers[type]
+
+def parseStatement (parser, text):
+    '''The AST of the single statement TEXT.'''
+    coroutine = parser.parse ()
+    coroutine.next ()
+    return coroutine.send (parser.tokenize (text))
+
+##-----------------------------------------------------------------------------
+## Lexer
+##
+
+class LexerTest (unittest.TestCase):
+    '''A terminal with a backreference can't go in a combined regex; it
+    must still be matched, longest match first and ties to the terminal
+    listed first.'''
+
+    STRING = re.compile (r'([\'"]).*?\1')
+
+    def lexer (self, *terminals):
+        return parser_generator.Lexer ([(re.compile (r' +'), None)] + list (terminals))
+
+    def testBackreference (self):
+        lexer = self.lexer ((LexerTest.STRING, 'string'), (re.compile (r'[a-z]+'), 'id'))
+        self.assertEqual (lexer.tokenize ('"ab" x \'c\' "it\'s"'),
+                          [('string', '"ab"'), ('id', 'x'), ('string', "'c'"), ('string', '"it\'s"')])
+        self.assertRaises (NameError, lexer.tokenize, '"ab')
+
+    def testLongestMatch (self):
+        keyword = (re.compile (r'"ab"'), 'keyword')
+        prefix = (re.compile (r'"a'), 'prefix')
+        lexer = self.lexer (prefix, keyword, (LexerTest.STRING, 'string'))
+        self.assertEqual (lexer.tokenize ('"ab" "abc" "a'),
+                          [('keyword', '"ab"'), ('string', '"abc"'), ('prefix', '"a')])
+        lexer = self.lexer ((LexerTest.STRING, 'string'), keyword)
+        self.assertEqual (lexer.tokenize ('"ab"'), [('string', '"ab"')])
+
+##-----------------------------------------------------------------------------
+## Parser
+##
+
+class InOperatorTest (unittest.TestCase):
+    ''''in' has no %left/%right declaration, so the Earley parser settles
+    it against the other operators by %dprec.  The ASTs are the ones the
+    parser produced before operator chains were parsed by precedence
+    climbing, which must not change them.'''
+
+    CASES = [
+        ('a in b && c',
+         ('exp', ('&&', ('in', ('var', 'a'), ('var', 'b')), ('var', 'c')))),
+        ('a && b in c',
+         ('exp', ('in', ('&&', ('var', 'a'), ('var', 'b')), ('var', 'c')))),
+        ('a in b + c',
+         ('exp', ('+', ('in', ('var', 'a'), ('var', 'b')), ('var', 'c')))),
+        ('a + b in c',
+         ('exp', ('in', ('+', ('var', 'a'), ('var', 'b')), ('var', 'c')))),
+        ('x in y * z',
+         ('exp', ('*', ('in', ('var', 'x'), ('var', 'y')), ('var', 'z')))),
+        ('x * y in z',
+         ('exp', ('in', ('*', ('var', 'x'), ('var', 'y')), ('var', 'z')))),
+        ('a in b in c',
+         ('exp', ('in', ('in', ('var', 'a'), ('var', 'b')), ('var', 'c')))),
+        ('a in b == c',
+         ('exp', ('==', ('in', ('var', 'a'), ('var', 'b')), ('var', 'c')))),
+        ('a == b in c',
+         ('exp', ('in', ('==', ('var', 'a'), ('var', 'b')), ('var', 'c')))),
+        ('a in b || c && d',
+         ('exp', ('&&', ('||', ('in', ('var', 'a'), ('var', 'b')), ('var', 'c')), ('var', 'd')))),
+        ('a in b - c * d',
+         ('exp', ('-', ('in', ('var', 'a'), ('var', 'b')), ('*', ('var', 'c'), ('var', 'd'))))),
+        ('if ("k" in d && x) { 1 }',
+         ('if', ('&&', ('in', ('string-lit', 'k'), ('var', 'd')), ('var', 'x')), [('exp', ('int-lit', 1))], None)),
+        ('print a in b < 1',
+         ('print', ('<', ('in', ('var', 'a'), ('var', 'b')), ('int-lit', 1)))),
+        ('a[b in c] = d in e + f',
+         ('put', ('var', 'a'), ('in', ('var', 'b'), ('var', 'c')),
+          ('+', ('in', ('var', 'd'), ('var', 'e')), ('var', 'f')))),
+        ('def y = lambda(a) { a in b } in c',
+         ('def', 'y', ('in', ('lambda', ['a'], [('exp', ('in', ('var', 'a'), ('var', 'b')))]), ('var', 'c')))),
+        ('f(a in b, c) in d && e',
+         ('exp', ('&&', ('in', ('call', ('var', 'f'), [('in', ('var', 'a'), ('var', 'b')), ('var', 'c')]),
+                                ('var', 'd')), ('var', 'e')))),
+    ]
+
+    def check (self, type):
+        parser = makeParser (type)
+        for text, ast in InOperatorTest.CASES:
+            self.assertEqual (parseStatement (parser, text), ast, text)
+
+    def testEarley (self):
+        self.check ('earley')
+
+    def testHybrid (self):
+        self.check ('hybrid')
+
+class NestingTest (unittest.TestCase):
+    '''Deeply nested expressions are parsed and their semantic actions
+    run without recursing, so they must not hit the recursion limit.'''
+
+    DEPTH = 10000
+
+    def check (self, type):
+        depth = NestingTest.DEPTH
+        text = 'def x = ' + '(1 + ' * depth + '1' + ')' * depth
+        ast = parseStatement (makeParser (type), text)
+        self.assertEqual (ast[:2], ('def', 'x'))
+        levels = 0
+        node = ast[2]
+        while node[0] == '+':
+            self.assertEqual (node[1], ('int-lit', 1))
+            node = node[2]
+            levels += 1
+        self.assertEqual ((levels, node), (depth, ('int-lit', 1)))
+
+    def testEarley (self):
+        self.check ('earley')
+
+    def testHybrid (self):
+        self.check ('hybrid')
+
+class ClimberTest (unittest.TestCase):
+    '''Operator chains built by precedence climbing (makeClimber) must
+    come out as disambiguate builds them from the ambiguous grammar.'''
+
+    OPERATORS = ['+', '-', '*', '/', '==', '!=', '<=', '>=', '<', '>', '&&', '||', 'in']
+    OPERANDS = ['a', '1', '"s"', 'b[c]', 'f(x)', 'o.k', '(p in q)']
+
+    def check (self, text, operators, operands):
+        climbing, plain = [parser_generator.EarleyParser (None, parser_generator.EarleyParser.compile (
+                               grammar_parser.parse (text), climb=climb)) for climb in (True, False)]
+        self.assertTrue ([rule for rule in climbing.grammar.rules if rule.lhs == '@E.operators'])
+        generator = random.Random (164)
+        for trial in range (300):
+            n = generator.randint (2, 9)
+            statement = 'def x = ' + ' '.join ([generator.choice (operands) + ' ' + generator.choice (operators)
+                                               for i in range (n - 1)]) + ' z'
+            self.assertEqual (parseStatement (climbing, statement),
+                              parseStatement (plain, statement), statement)
+
+    def testGrammar (self):
+        self.check (open (GRAMMAR_FILE).read (), ClimberTest.OPERATORS, ClimberTest.OPERANDS)
+
+    def testWithoutIn (self):
+        text = ''.join ([line for line in open (GRAMMAR_FILE).readlines () if "E 'in' E" not in line])
+        self.check (text, ClimberTest.OPERATORS[:-1], ClimberTest.OPERANDS[:-1])
+
+class OnDemandTest (unittest.TestCase):
+    '''Text sent to the parser is lexed on demand; it must be accepted or
+    rejected just as its batch tokens are, keywords included.'''
+
+    PIECES = ['def', 'if', 'else', 'while', 'for', 'in', 'print', 'lambda', 'len', 'null',
+              'x', 'inside', 'iffy', '1', '"s"', '=', '==', '+', '*', '&&', '(', ')',
+              '{', '}', '[', ']', ',', '.', ':', ';']
+
+    def outcome (self, parser, line):
+        '''The AST of LINE, None if it is incomplete, or the error that
+        rejects it.'''
+        coroutine = parser.parse ()
+        coroutine.next ()
+        try:
+            return coroutine.send (line)
+        except (SyntaxError, NameError):
+            return 'rejected'
+
+    def testKeywords (self):
+        parser = makeParser ()
+        for line in ['def if = 3', 'def f(while) { 1 }', 'print lambda.x', 'def inside = iffy']:
+            self.assertEqual (self.outcome (parser, line),
+                              self.outcome (parser, parser.tokenize (line)), line)
+        self.assertEqual (self.outcome (parser, 'def if = 3'), 'rejected')
+
+    def testRandomLines (self):
+        parser = makeParser ()
+        generator = random.Random (164)
+        for trial in range (1000):
+            line = ' '.join ([generator.choice (OnDemandTest.PIECES)
+                              for i in range (generator.randint (1, 8))])
+            self.assertEqual (self.outcome (parser, line),
+                              self.outcome (parser, parser.tokenize (line)), line)
+
+##-----------------------------------------------------------------------------
+## REPL
+##
+
+class TokenBufferTest (unittest.TestCase):
+    '''The incrementally lexed tokens of a line being edited must be
+    the ones tokenize would give for the whole line.'''
+
+    def setUp (self):
+        import repl
+        self.parser = makeParser ()
+        self.buffer = repl.TokenBuffer (self.parser.lexer, lambda lhs, lexeme: (0, 0))
+
+    def check (self, line):
+        try:
+            tokens, error = self.parser.tokenize (line), False
+        except NameError:
+            tokens, error = [], True
+        self.assertEqual ((self.buffer.tokens, self.buffer.error), (tokens, error), repr (line))
+
+    def testTypingEscapedQuote (self):
+        line = "print 'it\\'s ok'"
+        for i in range (1, len (line) + 1):
+            self.buffer.update (line[:i])
+            self.check (line[:i])
+
+    def testRandomEdits (self):
+        pieces = ['x', 'in', ' ', "'", '"', '\\', "\\'", '\\"', 'ab', '12', '(', ')', '#', '.', '=']
+        generator = random.Random (164)
+        for trial in range (300):
+            line = ''
+            self.buffer.update (line)
+            for step in range (30):
+                if generator.random () < 0.7 or not line:
+                    k = generator.randint (0, len (line))
+                    line = line[:k] + generator.choice (pieces) + line[k:]
+                else:
+                    k = generator.randint (0, len (line) - 1)
+                    line = line[:k] + line[k+1:]
+                self.buffer.update (line)
+                self.check (line)
+
+##-----------------------------------------------------------------------------
+## Interpreter
+##
+
+class TestRepl:
+    '''Stands in for the REPL the interpreter prints and reports errors to.'''
+    def __init__ (self):
+        self.output = []
+
+    def printLine (self, s, code=0, attr=0):
+        self.output.append (s)
+
+    def softError (self, s):
+        self.output.append ('Error: ' + s)
+
+    def gracefulExit (self, msg=None, ret=0):
+        raise SystemExit (msg)
+
+class RegistersTest (unittest.TestCase):
+    '''The temps of top-level code live in registers, so loading a
+    program again and again must not add to the global environment.'''
+
+    def testReloadLibrary (self):
+        import interpreter
+        from benchmark import parseProgram
+        asts = parseProgram (makeParser ('hybrid'), open ('library.164').read ())[0]
+        repl = TestRepl ()
+        for i in range (20):
+            for ast in asts:
+                interpreter.ExecGlobalStmt (ast, repl)
+            if i == 0:
+                names = set (interpreter.globEnv)
+        self.assertEqual (repl.output, [])
+        self.assertEqual (set (interpreter.globEnv), names)
+        self.assertEqual ([name for name in names if name.startswith ('$')], [])
+
+
+if __name__ == '__main__':
+    unittest.main ()